@@ -5,45 +5,286 @@ import hashlib
 import datetime
 import json
 import uuid # Needed if used in transactions
+import hmac
+import warnings
+import functools
+import operator
+
+try:
+    import orjson # Optional: C-backed JSON encoder, used for canonical serialization when installed
+except ImportError:
+    orjson = None
+
+# Block hashes are kept as raw 32-byte digests; hex is produced only for display.
+# hashlib should be the OpenSSL-backed implementation (SHA-NI capable); the builtin fallback works but is slower.
+HASH_BACKEND = "OpenSSL" if hashlib.sha256.__name__.startswith("openssl_") else "builtin"
+if HASH_BACKEND != "OpenSSL": warnings.warn("hashlib's sha256 is not OpenSSL-backed; block hashing and mining will be slower", RuntimeWarning)
+
+def cpu_has_sha_ni():
+    """ Reports whether /proc/cpuinfo advertises the SHA-NI extension (False when unavailable). """
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            return any(line.startswith("flags") and " sha_ni" in line for line in cpuinfo)
+    except OSError:
+        return False
+
+def hash_backend_description():
+    return "SHA-256 via {} (SHA-NI: {})".format(HASH_BACKEND, "yes" if cpu_has_sha_ni() else "no")
+
+def _difficulty_shift(difficulty):
+    """ Difficulty counts leading zero hex digits (4 bits each) within the first 64 bits of the digest. """
+    if not 0 <= difficulty <= 16: raise ValueError("difficulty must be between 0 and 16 hex digits")
+    return 64 - 4 * difficulty
+
+def _digest_meets_difficulty(digest, difficulty):
+    return int.from_bytes(digest[:8], 'big') >> _difficulty_shift(difficulty) == 0
+
+# Built once: json.dumps() with non-default options constructs a fresh JSONEncoder on every call.
+_CANONICAL_ENCODER = json.JSONEncoder(sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+# The value subset on which orjson and the stdlib encoder emit identical bytes. Outside it they differ (float formatting,
+# NaN/Infinity) or only one of them raises (ints beyond 64 bits, non-str keys, nesting past orjson's recursion limit).
+CANONICAL_MAX_DEPTH = 64
+CANONICAL_INT_MIN, CANONICAL_INT_MAX = -2**63, 2**64 - 1
+
+def is_canonical_value(obj, depth=0):
+    """ True if obj is built only from str, bool, None, 64-bit ints, lists and str-keyed dicts (exact types, bounded depth). """
+    kind = type(obj)
+    if kind is str or kind is bool or obj is None: return True
+    if kind is int: return CANONICAL_INT_MIN <= obj <= CANONICAL_INT_MAX
+    if depth >= CANONICAL_MAX_DEPTH: return False
+    if kind is list: return all(is_canonical_value(value, depth + 1) for value in obj)
+    if kind is dict: return all(type(key) is str and is_canonical_value(value, depth + 1) for key, value in obj.items())
+    return False
+
+def canonical_json(obj):
+    """
+    Canonical JSON bytes (sorted keys, compact separators, UTF-8) used for hashing.
+    orjson and the stdlib fallback emit identical bytes only for values accepted by is_canonical_value(); anything else
+    may hash differently depending on which encoder a node has, so transactions are checked against it at ingress.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    return _CANONICAL_ENCODER.encode(obj).encode()
+
+def pretty_json(obj):
+    """ Indented JSON for CLI display; orjson's indenting encoder is much faster than json.dumps(indent=2). """
+    if orjson is not None:
+        try: return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+        except TypeError: pass # e.g. non-str dict keys: let the stdlib encoder handle (or reject) them
+    return json.dumps(obj, indent=2)
+
+# Transaction timestamps are integer nanoseconds; these fields are rendered with iso() wherever a tx is displayed.
+TX_TIMESTAMP_FIELDS = ('timestamp', 'references_prescription_timestamp')
+
+@functools.lru_cache(maxsize=1024)
+def _iso_ms(ms): return datetime.datetime.fromtimestamp(ms / 1000).isoformat(sep=' ', timespec='milliseconds')
+
+def iso(ts_ns):
+    """ Human-readable local time for a tx timestamp (cached per millisecond). Non-int values are shown as-is. """
+    return _iso_ms(ts_ns // 1_000_000) if isinstance(ts_ns, int) else str(ts_ns)
+
+def display_tx(tx):
+    """ tx with its integer timestamps shown through iso(), as a copy; the tx itself (and so its hash) is untouched. """
+    if not isinstance(tx, dict) or not any(type(tx.get(field)) is int for field in TX_TIMESTAMP_FIELDS): return tx
+    shown = dict(tx)
+    for field in TX_TIMESTAMP_FIELDS:
+        if type(shown.get(field)) is int: shown[field] = iso(shown[field])
+    return shown
+
+# Fixed field layouts for the workflow transaction types: (type tag, getter for every other field, in order).
+# A tx is hashed through its layout only if it has exactly these keys; anything else takes the JSON path.
+_TX_LAYOUTS = {tx_type: (tag, operator.itemgetter(*fields), len(fields) + 1) for tx_type, tag, fields in (
+    ("TRANSFER_ECASH", 1, ('from', 'to', 'amount', 'reason', 'timestamp')),
+    ("PATIENT_REGISTRATION", 2, ('patient_id', 'patient_name', 'registered_by', 'timestamp')),
+    ("DOCTOR_CONSULTATION", 3, ('patient_id', 'doctor', 'notes', 'tests_ordered', 'timestamp')),
+    ("LAB_TEST_RESULT", 4, ('patient_id', 'test_name', 'performed_by', 'results', 'timestamp')),
+    ("PRESCRIPTION_FILLED", 6, ('patient_id', 'filled_by_pharmacy', 'references_prescription_timestamp', 'timestamp')),
+)}
+
+def _fixed_layout_bytes(tx):
+    """
+    Preimage tag byte | per field: kind + length + bytes (str as UTF-8, int as decimal, anything else as canonical JSON).
+    None if tx does not fit a layout. The tag byte (< 0x7b '{') keeps these preimages disjoint from canonical JSON.
+    """
+    tx_type = tx.get('type')
+    layout = _TX_LAYOUTS.get(tx_type) if type(tx_type) is str else None
+    if layout is None or len(tx) != layout[2]: return None
+    tag, fields, _ = layout
+    try: values = fields(tx)
+    except KeyError: return None
+    parts = [bytes((tag,))]
+    for value in values:
+        kind = type(value)
+        if kind is str: data = value.encode(); parts.append(b's')
+        elif kind is int: data = str(value).encode(); parts.append(b'i')
+        else: data = canonical_json(value); parts.append(b'j')
+        parts.append(len(data).to_bytes(4, 'little')); parts.append(data)
+    return b"".join(parts)
+
+def tx_digest(tx):
+    """
+    16-byte BLAKE2b identity of a transaction, the key for mempool dedup and mined-tx removal. Digests never leave the process.
+    With orjson its C encoder is the fastest preimage; without it the fixed layouts skip the pure-Python JSON encoder.
+    """
+    if orjson is None:
+        preimage = _fixed_layout_bytes(tx)
+        if preimage is not None: return hashlib.blake2b(preimage, digest_size=16).digest()
+    return hashlib.blake2b(canonical_json(tx), digest_size=16).digest()
+
+GENESIS_PREVIOUS_HASH = b"\x00" * 32
 
 class Block:
     """ Represents a single block in our blockchain. """
     def __init__(self, index, timestamp, transactions, previous_hash, nonce=0):
         self.index = index
         self.timestamp = timestamp if isinstance(timestamp, datetime.datetime) else datetime.datetime.now()
+        self.timestamp_str = str(self.timestamp) # datetime.__str__ is not free; format once for hashing and display
         self.transactions = transactions
         self.previous_hash = previous_hash
         self.nonce = nonce
+        self._tx_canonical = self._canonical_transactions() # Transactions never change after construction
+        self._prefix_bytes = self._hash_prefix()
+        self._cached_hash = None; self._cached_nonce = None # Digest for _cached_nonce; the prefix is fixed, so only the nonce can invalidate it
+        self._tx_digests = None # Lazily filled by tx_digests
         self.hash = self.calculate_hash() # Calculate hash immediately
 
-    def calculate_hash(self):
-        """ Calculates the SHA-256 hash of the block's contents. """
+    def _canonical_transactions(self):
+        """ Serializes the transactions once into canonical (sorted, compact) JSON bytes. """
         try:
-            block_string = json.dumps({
-                'index': self.index,
-                'timestamp': str(self.timestamp),
-                'transactions': self.transactions,
-                'previous_hash': self.previous_hash,
-                'nonce': self.nonce
-            }, sort_keys=True).encode()
-            return hashlib.sha256(block_string).hexdigest()
-        except TypeError as e:
+            return canonical_json(self.transactions)
+        except TypeError as e: # orjson.JSONEncodeError is a TypeError subclass
             print(f"Error serializing block for hashing: {e}")
-            return "error_hash"
+            return None
+
+    def _hash_prefix(self):
+        """
+        Builds every preimage byte that precedes the nonce.
+        Layout: index (8-byte LE) | len+timestamp | len+transactions | len+previous_hash (32 raw bytes), then nonce (8-byte LE).
+        Variable-length fields carry a 4-byte LE length prefix so field boundaries are unambiguous.
+        """
+        if self._tx_canonical is None: return None
+        timestamp_bytes = self.timestamp_str.encode()
+        return b"".join((
+            self.index.to_bytes(8, 'little'),
+            len(timestamp_bytes).to_bytes(4, 'little'), timestamp_bytes,
+            len(self._tx_canonical).to_bytes(4, 'little'), self._tx_canonical,
+            len(self.previous_hash).to_bytes(4, 'little'), self.previous_hash,
+        ))
+
+    def calculate_hash(self):
+        """
+        Calculates the raw SHA-256 digest (32 bytes) of the block's contents.
+        Computed at construction and reused until the nonce changes (everything before the nonce is fixed then).
+        """
+        if self._cached_nonce == self.nonce and self._cached_hash is not None: return self._cached_hash
+        if self._prefix_bytes is None: return b"error_hash"
+        self._cached_hash = self._hash_with_nonce(self.nonce); self._cached_nonce = self.nonce
+        return self._cached_hash
+
+    def verify_hash(self):
+        """ True if the stored (e.g. peer-claimed) hash matches the contents; constant-time compare against the cached digest. """
+        return isinstance(self.hash, bytes) and hmac.compare_digest(self.hash, self.calculate_hash())
+
+    def _hash_with_nonce(self, nonce):
+        return hashlib.sha256(self._prefix_bytes + nonce.to_bytes(8, 'little')).digest()
+
+    def meets_difficulty(self, difficulty):
+        """ True if the hash starts with `difficulty` zero hex digits, checked on the raw digest bytes. """
+        return _digest_meets_difficulty(self.hash, difficulty)
+
+    def mine(self, difficulty):
+        """
+        Proof-of-work: searches nonces until the hash meets the difficulty.
+        The nonce-independent prefix is built and absorbed into a SHA-256 midstate once; each trial only appends the 8-byte nonce.
+        """
+        if self._prefix_bytes is None: return False
+        self._cached_hash = self._cached_nonce = None # The nonce is about to change
+        shift = _difficulty_shift(difficulty)
+        midstate = hashlib.sha256(self._prefix_bytes) # SHA-256 state after the prefix; each trial copies it instead of re-hashing the prefix
+        nonce = self.nonce
+        while True:
+            h = midstate.copy(); h.update(nonce.to_bytes(8, 'little')); digest = h.digest()
+            if int.from_bytes(digest[:8], 'big') >> shift == 0:
+                self.nonce = self._cached_nonce = nonce; self.hash = self._cached_hash = digest
+                return True
+            nonce += 1
+
+    @property
+    def tx_digests(self):
+        """ tx_digest() of each transaction, computed once per block. """
+        if self._tx_digests is None: self._tx_digests = tuple(tx_digest(tx) for tx in self.transactions)
+        return self._tx_digests
+
+    def to_msgpack(self):
+        """ Wire form for msgpack: [index, iso timestamp, transactions, previous_hash, hash, nonce] (hashes stay raw bytes). """
+        return [self.index, self.timestamp.isoformat(), self.transactions, self.previous_hash, self.hash, self.nonce]
+
+    @classmethod
+    def from_msgpack(cls, fields):
+        """ Rebuilds a block received from a peer (fields already schema-checked). The claimed hash is kept as-is; callers verify it. """
+        index, timestamp, transactions, previous_hash, claimed_hash, nonce = fields
+        block = cls(index, datetime.datetime.fromisoformat(timestamp), transactions, previous_hash, nonce)
+        block.hash = claimed_hash
+        return block
+
+    @property
+    def hash_hex(self):
+        return self.hash.hex()
+
+    @property
+    def previous_hash_hex(self):
+        return self.previous_hash.hex()
 
     def __str__(self):
         return (f"Block #{self.index}\n"
-                f"Timestamp: {self.timestamp}\n"
-                f"Transactions: {json.dumps(self.transactions, indent=2)}\n"
-                f"Previous Hash: {self.previous_hash}\n"
-                f"Hash: {self.hash}\n"
+                f"Timestamp: {self.timestamp_str}\n"
+                f"Transactions: {pretty_json([display_tx(tx) for tx in self.transactions])}\n"
+                f"Previous Hash: {self.previous_hash_hex}\n"
+                f"Hash: {self.hash_hex}\n"
                 f"Nonce: {self.nonce}\n")
 
+class Chain:
+    """
+    Ordered list of blocks plus parallel per-field arrays (indices, timestamps as str, hashes, prev_hashes).
+    Validation and lookups walk the flat arrays instead of dereferencing each Block object.
+    Supports len(), iteration, reversed() and indexing like the plain list it replaces.
+    """
+    def __init__(self, blocks=()):
+        self.blocks = []
+        self.indices = []
+        self.timestamps = []
+        self.hashes = []
+        self.prev_hashes = []
+        for block in blocks: self.append(block)
+
+    def append(self, block):
+        self.blocks.append(block)
+        self.indices.append(block.index)
+        self.timestamps.append(block.timestamp_str)
+        self.hashes.append(block.hash)
+        self.prev_hashes.append(block.previous_hash)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def __reversed__(self):
+        return reversed(self.blocks)
+
+    def __getitem__(self, i):
+        return self.blocks[i]
+
 class Blockchain:
     """ Manages the chain of blocks FOR A SINGLE NODE. """
     def __init__(self):
-        self.chain = []
+        self.chain = Chain()
         self.difficulty = 2
+        self._patient_index = {} # patient_id -> [(block_index, tx), ...] in chain order
+        self._lab_result_by_test = {} # (patient_id, test_name) -> most recent (block_index, LAB_TEST_RESULT tx)
+        self._prescription_by_ts = {} # (patient_id, prescription timestamp) -> most recent PRESCRIPTION tx
         if not self.chain:
             self.create_genesis_block()
 
@@ -53,54 +294,116 @@ class Blockchain:
                 index=0,
                 timestamp=datetime.datetime.now(),
                 transactions=[{"type": "genesis", "details": "The beginning"}],
-                previous_hash="0"
+                previous_hash=GENESIS_PREVIOUS_HASH
             )
             genesis_block.hash = genesis_block.calculate_hash()
             self.chain.append(genesis_block)
+            self.rebuild_patient_index()
 
     def get_latest_block(self):
         return self.chain[-1] if self.chain else None
 
-    def add_block(self, block):
-        """ Adds a pre-validated block to the chain. Validation happens in Node. """
+    def add_block(self, block, on_tx=None):
+        """
+        Adds a pre-validated block to the chain. Validation happens in Node.
+        on_tx(tx), if given, is called for each transaction in the same pass that stages its index entries. Nothing is
+        committed until that pass has finished, so if on_tx (or indexing) raises, the chain and indexes are untouched.
+        on_tx must therefore only collect, not mutate shared state.
+        """
         latest_block = self.get_latest_block()
-        if latest_block and block.previous_hash == latest_block.hash and block.index == latest_block.index + 1:
-            self.chain.append(block)
-            return True
-        elif not latest_block and block.index == 0:
-             self.chain.append(block)
-             return True
-        else:
+        if not (latest_block and block.previous_hash == latest_block.hash and block.index == latest_block.index + 1
+                or not latest_block and block.index == 0):
             return False
+        updates = self._index_updates(block, on_tx)
+        self.chain.append(block)
+        self._commit_index_updates(updates)
+        return True
+
+    def replace_chain(self, new_chain):
+        """ Swaps in an already-validated chain (a Chain or a list of blocks); its indexes are built before the swap. """
+        new_chain = new_chain if isinstance(new_chain, Chain) else Chain(new_chain)
+        indexes = self._indexes_for(new_chain)
+        self.chain = new_chain
+        self._set_indexes(indexes)
+
+    def _index_updates(self, block, on_tx=None):
+        """
+        Stages a block's index entries without touching the indexes. Every key is hashed here,
+        so a transaction that cannot be indexed raises before anything is committed.
+        """
+        entries = []; lab_results = {}; prescriptions = {}
+        for tx in block.transactions:
+            if on_tx is not None: on_tx(tx)
+            patient_id = tx.get('patient_id')
+            if patient_id: # Node enforces the tx schema before blocks get here
+                entry = (block.index, tx); tx_type = tx.get('type')
+                hash(patient_id) # A patient id that cannot key the index raises here, before anything is committed
+                entries.append((patient_id, entry))
+                if tx_type == 'PRESCRIPTION': prescriptions[(patient_id, tx.get('timestamp'))] = tx
+                elif tx_type == 'LAB_TEST_RESULT': lab_results[(patient_id, tx.get('test_name'))] = entry
+        return entries, lab_results, prescriptions
+
+    def _commit_index_updates(self, updates, indexes=None):
+        """ Applies staged updates to indexes (default: the live ones). Keys were already hashed, so this cannot fail part-way. """
+        patient_index, lab_results, prescriptions = indexes or (self._patient_index, self._lab_result_by_test, self._prescription_by_ts)
+        entries, new_lab_results, new_prescriptions = updates
+        for patient_id, entry in entries: patient_index.setdefault(patient_id, []).append(entry)
+        lab_results.update(new_lab_results); prescriptions.update(new_prescriptions)
+
+    def _indexes_for(self, blocks):
+        """ Fresh (patient, lab-result, prescription) index maps for blocks; nothing is installed. """
+        indexes = ({}, {}, {})
+        for block in blocks: self._commit_index_updates(self._index_updates(block), indexes)
+        return indexes
+
+    def _set_indexes(self, indexes):
+        self._patient_index, self._lab_result_by_test, self._prescription_by_ts = indexes
+
+    def rebuild_patient_index(self):
+        self._set_indexes(self._indexes_for(self.chain))
 
     def is_chain_valid(self, chain_to_validate=None):
         """ Validates a given chain (or self.chain). """
         target_chain = chain_to_validate if chain_to_validate else self.chain
         if not target_chain: return False
-        if target_chain[0].index != 0 or target_chain[0].previous_hash != "0": return False
-        if target_chain[0].hash != target_chain[0].calculate_hash(): return False
-        for i in range(1, len(target_chain)):
-            current_block = target_chain[i]
-            previous_block = target_chain[i-1]
-            if current_block.hash != current_block.calculate_hash(): return False
-            if current_block.previous_hash != previous_block.hash: return False
-            if current_block.index != previous_block.index + 1: return False
+        if not isinstance(target_chain, Chain): target_chain = Chain(target_chain)
+        indices, hashes, prev_hashes = target_chain.indices, target_chain.hashes, target_chain.prev_hashes
+        if indices[0] != 0 or prev_hashes[0] != GENESIS_PREVIOUS_HASH: return False
+        computed_hashes = [block.calculate_hash() for block in target_chain.blocks] # Cached per block (computed when it was built)
+        if not all(isinstance(h, bytes) and hmac.compare_digest(h, c) for h, c in zip(hashes, computed_hashes)): return False
+        shift = _difficulty_shift(self.difficulty)
+        for i in range(1, len(indices)):
+            if prev_hashes[i] != hashes[i-1] or indices[i] != indices[i-1] + 1: return False
+            if int.from_bytes(hashes[i][:8], 'big') >> shift: return False
         return True
 
+    def get_latest_lab_result(self, patient_id, test_name):
+        """ Most recent (block_index, LAB_TEST_RESULT tx) for that test, or None; newer results of other tests do not hide it. O(1). """
+        return self._lab_result_by_test.get((patient_id, test_name))
+
+    def iter_patient_history_reverse(self, patient_id):
+        """ Lazily yields a patient's (block_index, tx) pairs newest first, from the patient index. """
+        return reversed(self._patient_index.get(patient_id, ()))
+
+    def get_prescription(self, patient_id, timestamp):
+        """ The PRESCRIPTION tx a fill refers to (patient id + prescription timestamp), or None. O(1). """
+        return self._prescription_by_ts.get((patient_id, timestamp))
+
     def get_patient_history(self, patient_id):
-        history = []
-        for block in self.chain:
-            for tx in block.transactions:
-                if isinstance(tx, dict) and tx.get('patient_id') == patient_id:
-                    history.append({
-                        "block_index": block.index,
-                        "timestamp": str(block.timestamp),
-                        "transaction": tx
-                    })
-        return history
+        """ Served from the patient index: O(patient history) instead of a full chain scan. """
+        return [{
+                    "block_index": block_index,
+                    "timestamp": self.chain.timestamps[block_index],
+                    "transaction": tx
+                } for block_index, tx in self._patient_index.get(patient_id, [])]
 
-    def __str__(self):
-        chain_str = f"Blockchain (Length: {len(self.chain)}):\n"
-        for block in self.chain:
+    @staticmethod
+    def format_chain(blocks):
+        """ Renders a list of blocks; lets callers format a snapshot without holding the node lock. """
+        chain_str = f"Blockchain (Length: {len(blocks)}):\n"
+        for block in blocks:
             chain_str += str(block) + "-" * 20 + "\n"
-        return chain_str
\ No newline at end of file
+        return chain_str
+
+    def __str__(self):
+        return self.format_chain(self.chain)
\ No newline at end of file
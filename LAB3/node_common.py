@@ -2,23 +2,42 @@
 
 import socket
 import threading
-import pickle
 import sys
 import argparse
 import time
-import json
 import uuid
 from datetime import datetime
 import traceback
 import csv
 import os
+import itertools
+import struct
+import bisect
+import re
+import selectors
+import queue
+from collections import deque, defaultdict
+from array import array
 
-from blockchain_core import Block, Blockchain
+import msgpack # Wire format: plain data only, so nothing a peer sends can execute code on decode
+
+try:
+    from numba import njit # Optional: compiles the transfer scan kernel; pure Python otherwise
+except ImportError:
+    njit = None
+
+from blockchain_core import Block, Blockchain, hash_backend_description, pretty_json, iso, display_tx, is_canonical_value, tx_digest as _tx_digest
 
 # --- Constants ---
-MSG_BUFFER_SIZE = 4096
-MSG_HEADER_FORMAT = "!I"
-MSG_HEADER_LENGTH = 4
+MSG_HEADER_FORMAT = "!IB" # payload length (uint32), message type byte
+_HDR = struct.Struct(MSG_HEADER_FORMAT)
+MSG_HEADER_LENGTH = _HDR.size
+MSG_MAX_LENGTH = 64 * 1024 * 1024 # Refuse to allocate receive buffers beyond this
+NETWORK_WORKERS = 4 # Threads decoding/processing frames; each connection is pinned to one so its messages stay ordered
+WORK_QUEUE_SIZE = 256 # Frames buffered per worker before the event loop waits (backpressure)
+PEER_MAX_QUEUED_FRAMES = 1024 # A peer with more unsent frames than this is too slow and gets disconnected
+PEER_SOCKET_BUFFER = 4 << 20 # SO_SNDBUF/SO_RCVBUF for peer sockets, so a full-chain send is not window-limited
+PENDING_SHARDS = 16 # Mempool lock stripes; a tx lives in shard digest[0] % PENDING_SHARDS
 
 MSG_TYPE_NEW_TRANSACTION = 1
 MSG_TYPE_NEW_BLOCK = 2
@@ -26,9 +45,18 @@ MSG_TYPE_REQUEST_CHAIN = 3
 MSG_TYPE_SEND_CHAIN = 4
 MSG_TYPE_REQUEST_PEERS = 5
 MSG_TYPE_SEND_PEERS = 6
-TX_TRANSFER_ECASH = "TRANSFER_ECASH"
+MSG_FLAG_MSGPACK = 0x80 # High bit of the type byte marks a msgpack payload; frames without it (legacy pickle) are rejected
+# Transaction types are interned, and incoming tx types are interned against them, so the ledger/history loops compare by identity
+TX_TRANSFER_ECASH = sys.intern("TRANSFER_ECASH")
+TX_PATIENT_REGISTRATION = sys.intern("PATIENT_REGISTRATION")
+TX_DOCTOR_CONSULTATION = sys.intern("DOCTOR_CONSULTATION")
+TX_LAB_TEST_RESULT = sys.intern("LAB_TEST_RESULT")
+TX_PRESCRIPTION = sys.intern("PRESCRIPTION")
+TX_PRESCRIPTION_FILLED = sys.intern("PRESCRIPTION_FILLED")
 SYSTEM_ACCOUNT = "SYSTEM_BANK_001"
 INITIAL_SYSTEM_BALANCE = 1000000
+ECASH_MAX_AMOUNT = 2**63 - 1 # Amounts live in int64 ledger columns
+BALANCE_MIN, BALANCE_MAX = -2**63, 2**63 - 1 # Balances too: a transfer that would push one outside int64 is invalid everywhere
 
 # --- Shared User Management and Balances ---
 USERS = {
@@ -36,12 +64,259 @@ USERS = {
     "lab_tech_bob": {"password": "labpass", "role": "lab", "name": "Bob (Lab)"},
     "pharm_charlie": {"password": "pharmpass", "role": "pharmacy", "name": "Charlie (Pharmacy)"}
 }
-E_CASH_BALANCES = {user: 0 for user in USERS}
-E_CASH_BALANCES[SYSTEM_ACCOUNT] = INITIAL_SYSTEM_BALANCE
 
 # --- CSV File Configuration ---
 PATIENT_CSV_FILENAME = "patient_registry.csv"
 PATIENT_CSV_HEADER = ['patient_id', 'patient_name', 'registered_by', 'timestamp']
+CSV_QUEUE_SIZE = 4096 # Rows waiting for the CSV writer thread before register_new_patient blocks
+CSV_BATCH_ROWS = 50 # Group commit: write + fsync once this many rows are queued...
+CSV_BATCH_SECONDS = 0.2 # ...or once the oldest queued row has waited this long
+CSV_BUFFER_BYTES = 1 << 20
+_CSV_STOP = object() # Queue sentinel: flush what is queued and exit the writer
+
+# --- Timestamps ---
+# Transaction timestamps are integer nanoseconds since the epoch: no strftime per tx, identical
+# across node timezones, and numeric in the canonical JSON. Format with iso() only for display.
+_last_ts_ns = 0
+_ts_lock = threading.Lock()
+
+def _now_ns():
+    """ time.time_ns(), made strictly increasing within the process (uint64-safe until 2554). """
+    global _last_ts_ns
+    with _ts_lock:
+        ts = time.time_ns()
+        if ts <= _last_ts_ns: ts = _last_ts_ns + 1 # Same tick, or the wall clock stepped back
+        _last_ts_ns = ts
+        return ts
+
+# --- Wire Format ---
+def _is_hash(value): return isinstance(value, bytes) and len(value) == 32
+
+def _check_block_fields(fields):
+    """ Schema for Block.to_msgpack(): [index, iso timestamp, transactions, previous_hash, hash, nonce]. """
+    if not (isinstance(fields, list) and len(fields) == 6): raise ValueError("block must be a 6-item list")
+    index, timestamp, transactions, previous_hash, claimed_hash, nonce = fields
+    if not (isinstance(index, int) and index >= 0 and isinstance(timestamp, str) and isinstance(transactions, list)
+            and _is_hash(previous_hash) and _is_hash(claimed_hash) and isinstance(nonce, int) and 0 <= nonce < 2**64):
+        raise ValueError("block fields have the wrong types")
+
+def _check_peer(addr):
+    if not (isinstance(addr, list) and len(addr) == 2 and isinstance(addr[0], str) and isinstance(addr[1], int)): raise ValueError("peer must be [host, port]")
+
+def _to_wire(msg_type, data):
+    """ Maps message data to msgpack primitives (Blocks become field lists). """
+    if msg_type == MSG_TYPE_NEW_BLOCK: return data.to_msgpack()
+    if msg_type == MSG_TYPE_SEND_CHAIN: return [block.to_msgpack() for block in data]
+    return data
+
+def _from_wire(msg_type, data):
+    """ Schema-checks a decoded payload and maps it back (Blocks, peer tuples). Raises ValueError on anything unexpected. """
+    if msg_type == MSG_TYPE_NEW_TRANSACTION:
+        if not isinstance(data, dict): raise ValueError("transaction must be a map")
+        return data # Field-level checks happen in validate_transaction
+    if msg_type == MSG_TYPE_NEW_BLOCK:
+        _check_block_fields(data); return Block.from_msgpack(data)
+    if msg_type == MSG_TYPE_SEND_CHAIN:
+        if not isinstance(data, list): raise ValueError("chain must be a list")
+        for fields in data: _check_block_fields(fields)
+        return [Block.from_msgpack(fields) for fields in data]
+    if msg_type == MSG_TYPE_SEND_PEERS:
+        if not isinstance(data, list): raise ValueError("peers must be a list")
+        for addr in data: _check_peer(addr)
+        return [tuple(addr) for addr in data]
+    if msg_type in (MSG_TYPE_REQUEST_CHAIN, MSG_TYPE_REQUEST_PEERS): return data # Payload is ignored
+    raise ValueError("unknown message type {}".format(msg_type)) # Use format
+
+def encode_message(msg_type, data):
+    """ Returns (type byte, payload parts) for send_message to gather-write without joining. """
+    return msg_type | MSG_FLAG_MSGPACK, [msgpack.packb(_to_wire(msg_type, data), use_bin_type=True)]
+
+def decode_message(type_byte, payload):
+    """ Returns (msg_type, data) for a received frame. Raises ValueError if the payload cannot be decoded or fails the schema. """
+    if not type_byte & MSG_FLAG_MSGPACK: raise ValueError("non-msgpack payload (pickle is not accepted)")
+    msg_type = type_byte & ~MSG_FLAG_MSGPACK
+    try: data = msgpack.unpackb(payload, raw=False)
+    except Exception as e: raise ValueError("malformed msgpack payload: {}".format(e)) # Use format; msgpack raises several unrelated types
+    return msg_type, _from_wire(msg_type, data)
+
+_BUFFER_OPTIONS = [(socket.SOL_SOCKET, socket.SO_SNDBUF, PEER_SOCKET_BUFFER), (socket.SOL_SOCKET, socket.SO_RCVBUF, PEER_SOCKET_BUFFER)]
+_PEER_SOCKET_OPTIONS = _BUFFER_OPTIONS + [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1), (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, 'TCP_QUICKACK'): _PEER_SOCKET_OPTIONS.append((socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)) # Linux only
+
+def _tune_socket(sock, options=_PEER_SOCKET_OPTIONS):
+    """
+    Peer socket options: no Nagle delay on small broadcasts, 4 MiB buffers for chain sync, keepalives for dead peers.
+    Best effort: an option the platform refuses is skipped. Buffers must be set before connect/listen to affect window scaling.
+    """
+    for level, option, value in options:
+        try: sock.setsockopt(level, option, value)
+        except OSError: pass
+
+def _send_parts(sock, parts):
+    """
+    Gather-writes parts with sendmsg (no header + payload concatenation) on a non-blocking socket.
+    Returns the unsent tail as a list of memoryviews (empty once everything is written).
+    """
+    views = [memoryview(part).cast('B') for part in parts if len(part)]
+    while views:
+        try: sent = sock.sendmsg(views) if hasattr(sock, 'sendmsg') else sock.send(views[0]) # No sendmsg on Windows
+        except BlockingIOError: break
+        while sent:
+            if sent >= len(views[0]): sent -= len(views[0]); views.pop(0)
+            else: views[0] = views[0][sent:]; sent = 0
+    return views
+
+class _Connection:
+    """ Per-peer state for the selector loop: frame reassembly buffers, queued output and the worker that owns its frames. """
+    def __init__(self, sock, addr, worker):
+        self.sock = sock
+        self.addr = addr
+        self.worker = worker
+        self.header = bytearray(MSG_HEADER_LENGTH); self.header_view = memoryview(self.header)
+        self.msg_type = None; self.payload = None; self.payload_view = None # payload is preallocated once the header is parsed
+        self.received = 0 # Bytes of the current header or payload received so far
+        self.out_lock = threading.Lock(); self.out_frames = deque() # Unsent frames (lists of memoryviews); a partial send leaves its residue at the head
+        self.closed = False
+        self.dropping = False # Set when the peer overflowed its queue; the loop thread closes it
+
+_WAKEUP = object() # selector key data for the loop's wakeup socket
+
+# --- Transaction Schema (enforced at ingress so the hot loops can skip per-tx type checks) ---
+# Fields the chain indexes, the fill lookup and the balance map use as dict/set keys: they must be hashable scalars,
+# or indexing a block would raise part-way through, after it has already been appended.
+_TX_KEY_FIELDS = ('patient_id', 'timestamp', 'test_name', 'references_prescription_timestamp')
+
+def validate_transaction(tx):
+    """ True if tx is a well-formed transaction dict; interns tx['type'] in place. """
+    if not isinstance(tx, dict) or not isinstance(tx.get('type'), str): return False
+    if not is_canonical_value(tx): return False # Otherwise nodes with and without orjson could hash its block differently
+    if not all(isinstance(tx[k], (str, int)) for k in _TX_KEY_FIELDS if k in tx): return False
+    if not isinstance(tx.get('tests_ordered', []), list): return False # Searched with 'in' by the lab-order reward
+    tx['type'] = sys.intern(tx['type'])
+    if tx['type'] is TX_TRANSFER_ECASH:
+        return (all(k in tx for k in ('from', 'to', 'amount')) and isinstance(tx['from'], str) and isinstance(tx['to'], str)
+                and isinstance(tx['amount'], int) and 0 < tx['amount'] <= ECASH_MAX_AMOUNT)
+    return True
+
+def validate_block_transactions(block):
+    """ Schema check for every transaction in a block received from a peer. """
+    return isinstance(block.transactions, list) and all(validate_transaction(tx) for tx in block.transactions)
+
+def _initial_balances():
+    """ Genesis balances; a defaultdict(int) so applying a transfer never needs an 'if user not in' guard. """
+    balances = defaultdict(int, {user: 0 for user in USERS}); balances[SYSTEM_ACCOUNT] = INITIAL_SYSTEM_BALANCE
+    return balances
+
+def _transfer_allowed(balances, sender, recipient, amount):
+    """ The rule _scan_transfers applies with check_funds: non-system senders need the funds, and no balance may leave int64. """
+    return ((sender == SYSTEM_ACCOUNT or balances[sender] >= amount)
+            and balances[sender] >= BALANCE_MIN + amount and balances[recipient] <= BALANCE_MAX - amount)
+
+def _scan_transfers(senders, recipients, amounts, count, balances, system_id, check_funds):
+    """
+    Applies the first count transfers to balances (indexed by user id) in place. With check_funds, returns the index of
+    the first transfer _transfer_allowed() would refuse (checked before it is applied, so the int64 columns never wrap
+    or overflow, compiled or not); otherwise, or if every transfer is allowed, -1.
+    """
+    for i in range(count):
+        sender = senders[i]; recipient = recipients[i]; amount = amounts[i]
+        if check_funds and ((sender != system_id and balances[sender] < amount)
+                            or balances[sender] < BALANCE_MIN + amount or balances[recipient] > BALANCE_MAX - amount): return i
+        balances[sender] -= amount; balances[recipient] += amount
+    return -1
+
+if njit is not None: _scan_transfers = njit(cache=True, nogil=True)(_scan_transfers)
+
+class TransferLedger:
+    """
+    Struct-of-arrays copy of a chain's e-cash transfers: parallel sender/recipient/amount columns with users
+    interned to small ints, plus block_ends[i] = number of transfers in blocks 0..i.
+    """
+    def __init__(self):
+        self.users = []; self.user_ids = {}
+        self.senders = array('i'); self.recipients = array('i'); self.amounts = array('q'); self.block_ends = array('q')
+        for user in _initial_balances(): self.user_id(user)
+
+    def user_id(self, user):
+        uid = self.user_ids.get(user)
+        if uid is None: uid = self.user_ids[user] = len(self.users); self.users.append(user)
+        return uid
+
+    def append_transfer(self, sender, recipient, amount):
+        self.senders.append(self.user_id(sender)); self.recipients.append(self.user_id(recipient)); self.amounts.append(amount)
+    def end_block(self): self.block_ends.append(len(self.amounts))
+
+    def append_block(self, block):
+        for tx in block.transactions:
+             if tx['type'] is TX_TRANSFER_ECASH: self.append_transfer(tx['from'], tx['to'], tx['amount'])
+        self.end_block()
+
+    def scan(self, count=None, check_funds=False):
+        """ (balances dict after the first count transfers, index of the first overdraft or -1). """
+        if count is None: count = len(self.amounts)
+        initial = _initial_balances()
+        balances = array('q', [initial[user] for user in self.users])
+        overdraft = _scan_transfers(self.senders, self.recipients, self.amounts, count, balances, self.user_ids[SYSTEM_ACCOUNT], check_funds)
+        return dict(zip(self.users, balances)), overdraft
+
+# --- Locking ---
+class _LockSide:
+    """ Context manager for one side of an RWLock. """
+    __slots__ = ('_acquire', '_release')
+    def __init__(self, acquire, release): self._acquire = acquire; self._release = release
+    def __enter__(self): self._acquire()
+    def __exit__(self, exc_type, exc, tb): self._release()
+
+class RWLock:
+    """
+    Reader-writer lock: any number of readers or one writer; waiting writers block new readers.
+    Both sides are re-entrant per thread, and the writer may also take the read side. Upgrading
+    a held read side to the write side is refused (it would deadlock). 'with lock:' takes the write side.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0 # Threads holding the read side (the writer's nested reads are not counted)
+        self._writer = None; self._write_depth = 0; self._writers_waiting = 0
+        self._local = threading.local() # Per-thread read depth
+        self.read = _LockSide(self.acquire_read, self.release_read)
+        self.write = _LockSide(self.acquire_write, self.release_write)
+
+    def acquire_read(self):
+        local = self._local; depth = getattr(local, 'depth', 0)
+        if depth: local.depth = depth + 1; return
+        me = threading.get_ident()
+        with self._cond:
+            local.under_write = (self._writer == me)
+            if not local.under_write:
+                while self._writer is not None or self._writers_waiting: self._cond.wait()
+                self._readers += 1
+        local.depth = 1
+
+    def release_read(self):
+        local = self._local; local.depth -= 1
+        if local.depth or local.under_write: return
+        with self._cond:
+            self._readers -= 1
+            if not self._readers: self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me: self._write_depth += 1; return
+            if getattr(self._local, 'depth', 0): raise RuntimeError("RWLock: cannot upgrade a held read lock to a write lock")
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers: self._cond.wait()
+            finally: self._writers_waiting -= 1
+            self._writer = me; self._write_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._write_depth -= 1
+            if not self._write_depth: self._writer = None; self._cond.notify_all()
+
+    __enter__ = acquire_write
+    def __exit__(self, exc_type, exc, tb): self.release_write()
 
 # --- Node Class (Common Logic) ---
 class Node:
@@ -51,22 +326,40 @@ class Node:
         self.node_id = node_id if node_id else "{}:{}".format(host, port) # Use format for compatibility
         self.peers = {}
         self.peer_addresses_to_connect = set(peers_addr)
+        self._peers_lock = threading.Lock() # Guards peers, peer_addresses_to_connect and _connecting
+        self._connecting = set() # Outgoing connects in flight, so the same address is never dialled twice
         self.blockchain = Blockchain()
-        self.pending_transactions = []
+        self._tx_shards = [(threading.Lock(), {}) for _ in range(PENDING_SHARDS)] # (lock, {tx digest: (seq, tx)})
+        self._pending_seq = itertools.count() # Arrival order across shards, so mining stays FIFO
         self.server_socket = None
         self.stop_event = threading.Event()
-        self.lock = threading.Lock()
-        self.csv_lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair() # Lets other threads interrupt select()
+        self._wakeup_recv.setblocking(False); self._wakeup_send.setblocking(False)
+        self._loop_requests = queue.SimpleQueue() # (action, _Connection) for the loop thread
+        self._loop_thread = None
+        self._conns = {} # socket -> _Connection
+        self._work_queues = [queue.Queue(maxsize=WORK_QUEUE_SIZE) for _ in range(NETWORK_WORKERS)]
+        self._worker_rr = itertools.count()
+        self.lock = RWLock() # Queries take lock.read; chain/mempool/balance mutation takes the write side ('with self.lock')
+        self._csv_queue = queue.Queue(maxsize=CSV_QUEUE_SIZE) # Patient CSV rows; only _csv_writer touches the file
+        self._csv_thread = threading.Thread(target=self._csv_writer, daemon=True)
+        self._csv_thread.start()
         self.current_user = None
+        self.balances = _initial_balances() # Balances at the chain tip, applied block by block
+        self._tip = (-1, None) # (index, hash) of the latest block; replaced whole under the write lock, read without it
+        self._history_cache = (None, {}) # (tip hash it is valid for, {patient_id: history}); swapped whole when the tip moves
 
         self._recalculate_all_balances()
+        print("[Crypto] {}".format(hash_backend_description())) # Use format
         print("Node {} initialized on {}:{}".format(self.node_id, self.host, self.port)) # Use format
 
     # --- Networking Methods ---
     def start(self):
         if not self._start_server(): return
-        listener_thread = threading.Thread(target=self._listen_for_connections, daemon=True)
-        listener_thread.start()
+        for work_queue in self._work_queues: threading.Thread(target=self._worker, args=(work_queue,), daemon=True).start()
+        self._loop_thread = threading.Thread(target=self._event_loop, daemon=True)
+        self._loop_thread.start()
         connector_thread = threading.Thread(target=self._connect_to_peers_periodically, daemon=True)
         connector_thread.start()
         sync_thread = threading.Thread(target=self._initial_sync, daemon=True)
@@ -77,203 +370,284 @@ class Node:
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            _tune_socket(self.server_socket, _BUFFER_OPTIONS) # Accepted sockets inherit the buffer sizes from the listener
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
+            self.server_socket.listen(5); self.server_socket.setblocking(False)
             print("Server listening on {}:{}".format(self.host, self.port)) # Use format
             return True
         except OSError as e: print("!!! Error starting server on {}:{}: {}".format(self.host, self.port, e)); return False # Use format
 
-    def _listen_for_connections(self):
+    def _event_loop(self):
+        """ Single selector thread: accepts peers, reassembles frames, flushes queued output. Frames are handed to the workers. """
+        selector = self._selector
+        selector.register(self.server_socket, selectors.EVENT_READ, None)
+        selector.register(self._wakeup_recv, selectors.EVENT_READ, _WAKEUP)
         while not self.stop_event.is_set():
-            try:
-                self.server_socket.settimeout(1.0)
-                client_socket, addr = self.server_socket.accept()
-                client_socket.settimeout(None); self.peers[addr] = client_socket
-                handler_thread = threading.Thread(target=self._handle_connection, args=(client_socket, addr), daemon=True); handler_thread.start()
-            except socket.timeout: continue
+            try: events = selector.select(timeout=1.0)
+            except OSError as e: print("[Network] Selector error: {}".format(e)); break # Use format
+            for key, mask in events:
+                if key.data is None: self._accept_connections()
+                elif key.data is _WAKEUP:
+                    try: self._wakeup_recv.recv(4096)
+                    except BlockingIOError: pass
+                else:
+                    conn = key.data
+                    try:
+                        if mask & selectors.EVENT_READ: self._on_readable(conn)
+                        if mask & selectors.EVENT_WRITE and not conn.closed: self._on_writable(conn)
+                    except ValueError as e: print("\n[Network] {} from peer {}. Disconnecting.".format(e, conn.addr)); self._close_connection(conn) # Use format
+                    except OSError: self._close_connection(conn) # Includes ConnectionResetError/ConnectionAbortedError/BrokenPipeError
+            self._run_loop_requests()
+        for conn in list(self._conns.values()): self._close_connection(conn)
+        try: selector.close(); self.server_socket.close()
+        except OSError: pass
+
+    def _accept_connections(self):
+        while True:
+            try: client_socket, addr = self.server_socket.accept()
+            except BlockingIOError: return
             except OSError as e:
-                if not self.stop_event.is_set(): print("[Network] Error accepting connections: {}".format(e)); break # Use format
+                if not self.stop_event.is_set(): print("[Network] Error accepting connections: {}".format(e)) # Use format
+                return
+            client_socket.setblocking(False); _tune_socket(client_socket)
+            conn = self._add_connection(client_socket, addr)
+            if conn is None: client_socket.close(); continue
+            self._selector.register(client_socket, selectors.EVENT_READ, conn)
+
+    def _on_readable(self, conn):
+        """ Header/payload state machine; reads straight into preallocated buffers until the socket would block. """
+        while not conn.closed:
+            target = conn.header_view if conn.payload is None else conn.payload_view
+            try: nbytes = conn.sock.recv_into(target[conn.received:])
+            except BlockingIOError: return
+            if not nbytes: raise ConnectionAbortedError("Peer disconnected")
+            conn.received += nbytes
+            if conn.received < len(target): continue
+            conn.received = 0
+            if conn.payload is None:
+                msg_len, conn.msg_type = _HDR.unpack(conn.header)
+                if msg_len > MSG_MAX_LENGTH: raise ValueError("Oversized message ({} bytes)".format(msg_len)) # Use format
+                conn.payload = bytearray(msg_len); conn.payload_view = memoryview(conn.payload)
+                if msg_len: continue
+            self._work_queues[conn.worker].put((conn, conn.msg_type, conn.payload)) # Blocks when that worker is behind
+            conn.payload = conn.payload_view = None
+
+    def _on_writable(self, conn):
+        with conn.out_lock:
+            out_frames = conn.out_frames
+            while out_frames:
+                residue = _send_parts(conn.sock, out_frames[0])
+                if residue: out_frames[0] = residue; return # Socket is full again; wait for the next EVENT_WRITE
+                out_frames.popleft()
+            self._selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+    def _worker(self, work_queue):
+        while True:
+            item = work_queue.get()
+            if item is None: return
+            conn, type_byte, payload = item
+            try: msg_type, message = decode_message(type_byte, payload); self._process_message(msg_type, message, conn.addr, conn.sock)
+            except ValueError: print("\n[Network] Invalid data received from peer {}.".format(conn.addr)) # Use format
             except Exception as e:
-                if not self.stop_event.is_set(): print("[Network] Unexpected error in listener: {}".format(e)); time.sleep(1) # Use format
+                if not self.stop_event.is_set(): print("\n[Network] Unexpected error handling message from {}: {}".format(conn.addr, e)); traceback.print_exc() # Use format
+
+    # Selector registrations are only changed on the loop thread; other threads queue a request and wake it.
+    def _loop_request(self, action, conn):
+        self._loop_requests.put((action, conn)); self._wake()
+    def _wake(self):
+        try: self._wakeup_send.send(b"\0")
+        except OSError: pass # Wakeup already pending (buffer full) or the loop is gone
+    def _run_loop_requests(self):
+        while True:
+            try: action, conn = self._loop_requests.get_nowait()
+            except queue.Empty: return
+            if conn.closed: continue
+            try:
+                if action == 'add': self._selector.register(conn.sock, selectors.EVENT_READ, conn)
+                elif action == 'write':
+                    with conn.out_lock:
+                        if conn.out_frames: self._selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+                elif action == 'close': self._close_connection(conn)
+            except (OSError, ValueError, KeyError): self._close_connection(conn)
+
+    def _add_connection(self, sock, addr):
+        """ Registers sock as the connection for addr; None if addr already has one (the caller closes sock). """
+        with self._peers_lock:
+            if addr in self.peers: return None
+            conn = _Connection(sock, addr, next(self._worker_rr) % NETWORK_WORKERS)
+            self._conns[sock] = conn; self.peers[addr] = sock
+        return conn
+
+    def _close_connection(self, conn):
+        """ Loop thread only. """
+        if conn.closed: return
+        conn.closed = True
+        try: self._selector.unregister(conn.sock)
+        except (KeyError, ValueError): pass
+        with self._peers_lock:
+            if self.peers.get(conn.addr) is conn.sock: del self.peers[conn.addr]
+        self._conns.pop(conn.sock, None)
+        try: conn.sock.close()
+        except OSError: pass
 
     def _connect_to_peers_periodically(self):
         while not self.stop_event.is_set():
-            peers_to_try = list(self.peer_addresses_to_connect)
+            with self._peers_lock: peers_to_try = list(self.peer_addresses_to_connect)
             for peer_host, peer_port in peers_to_try:
-                peer_addr = (peer_host, peer_port); is_self = (peer_host == self.host and peer_port == self.port)
-                if not is_self and peer_addr not in self.peers: self._connect_to_peer(peer_host, peer_port)
-            time.sleep(15)
+                is_self = (peer_host == self.host and peer_port == self.port)
+                if not is_self: self._connect_to_peer(peer_host, peer_port) # Skips peers already connected or being dialled
+            self.stop_event.wait(15)
 
     def _connect_to_peer(self, peer_host, peer_port):
         peer_addr = (peer_host, peer_port)
+        with self._peers_lock:
+            if peer_addr in self.peers or peer_addr in self._connecting: return
+            self._connecting.add(peer_addr)
+        sock = None
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM); sock.settimeout(5.0); sock.connect(peer_addr)
-            sock.settimeout(None); print("[Network] Connected to peer {}:{}".format(peer_host, peer_port)); self.peers[peer_addr] = sock # Use format
-            handler_thread = threading.Thread(target=self._handle_connection, args=(sock, peer_addr), daemon=True); handler_thread.start()
-        except (socket.timeout, OSError): pass
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM); _tune_socket(sock); sock.settimeout(5.0); sock.connect(peer_addr)
+            sock.setblocking(False); conn = self._add_connection(sock, peer_addr)
+            if conn is None: sock.close(); return
+            print("[Network] Connected to peer {}:{}".format(peer_host, peer_port)); self._loop_request('add', conn) # Use format
+        except (socket.timeout, OSError):
+            if sock is not None: sock.close()
         except Exception as e:
              if not self.stop_event.is_set(): print("[Network] Unexpected error connecting to {}: {}".format(peer_addr, e)) # Use format
-
-    def _handle_connection(self, client_socket, addr):
-        while not self.stop_event.is_set():
-            try:
-                header = client_socket.recv(MSG_HEADER_LENGTH)
-                if not header or len(header) < MSG_HEADER_LENGTH: break
-                msg_len = int.from_bytes(header[:MSG_HEADER_LENGTH-1], byteorder='big'); msg_type = int.from_bytes(header[MSG_HEADER_LENGTH-1:], byteorder='big')
-                data = b""; bytes_recd = 0
-                while bytes_recd < msg_len:
-                    chunk = client_socket.recv(min(msg_len - bytes_recd, MSG_BUFFER_SIZE));
-                    if not chunk: raise ConnectionAbortedError("Peer disconnected")
-                    data += chunk; bytes_recd += len(chunk)
-                message = pickle.loads(data); self._process_message(msg_type, message, addr, client_socket)
-            except (socket.timeout, ConnectionResetError, ConnectionAbortedError, BrokenPipeError): break
-            except pickle.UnpicklingError: print("\n[Network] Invalid data received from peer {}.".format(addr)); continue # Use format
-            except OSError: break
-            except Exception as e:
-                if not self.stop_event.is_set(): print("\n[Network] Unexpected error handling connection with {}: {}".format(addr, e)); traceback.print_exc() # Use format
-                break
-        if addr in self.peers:
-            try: del self.peers[addr]
-            except KeyError: pass
-        try: client_socket.close()
-        except: pass
+        finally:
+            with self._peers_lock: self._connecting.discard(peer_addr)
 
     def send_message(self, sock, msg_type, data):
-        try:
-            serialized_data = pickle.dumps(data); msg_len = len(serialized_data)
-            header = msg_len.to_bytes(3, byteorder='big') + msg_type.to_bytes(1, byteorder='big')
-            sock.sendall(header + serialized_data)
-        except (OSError, BrokenPipeError):
-            peer_addr = None;
-            try: peer_addr = sock.getpeername()
-            except: pass
-            if peer_addr and peer_addr in self.peers:
-                 try: del self.peers[peer_addr]
-                 except KeyError: pass
-            try: sock.close()
-            except: pass
+        """
+        Writes what the socket accepts now; the rest is queued on the peer's bounded frame queue and flushed by the
+        event loop. Never blocks, so one slow peer cannot stall a broadcast.
+        """
+        conn = self._conns.get(sock)
+        if conn is None or conn.closed or conn.dropping: return
+        try: type_byte, parts = encode_message(msg_type, data); msg_len = sum(memoryview(part).nbytes for part in parts)
         except Exception as e:
              if not self.stop_event.is_set(): print("[Network] Unexpected error sending message: {}".format(e)) # Use format
+             return
+        frame = [_HDR.pack(msg_len, type_byte), *parts]
+        with conn.out_lock:
+            if not conn.out_frames: # Nothing queued ahead of this frame: try the gather write directly
+                try: frame = _send_parts(sock, frame)
+                except OSError: self._loop_request('close', conn); return
+                if not frame: return
+            elif len(conn.out_frames) >= PEER_MAX_QUEUED_FRAMES:
+                print("[Network] Peer {} has {} unsent frames. Disconnecting slow peer.".format(conn.addr, len(conn.out_frames))) # Use format
+                conn.dropping = True; self._loop_request('close', conn); return
+            conn.out_frames.append(frame)
+        self._loop_request('write', conn)
 
     def broadcast(self, msg_type, data, exclude_addr=None):
-        peers_to_broadcast = list(self.peers.items())
+        with self._peers_lock: peers_to_broadcast = list(self.peers.items())
         for addr, sock in peers_to_broadcast:
             if addr != exclude_addr: self.send_message(sock, msg_type, data)
 
+    # --- Snapshots (copy under the lock, format outside it) ---
+    def snapshot_pending(self):
+        return self.pending_transactions
+    def snapshot_peers(self):
+        with self._peers_lock: return list(self.peers.keys())
+    def snapshot_chain(self):
+        with self.lock.read: return list(self.blockchain.chain)
+
     def stop(self):
         print("\n--- Stopping Node {} ---".format(self.node_id)); self.stop_event.set() # Use format
-        if self.server_socket: self.server_socket.close()
-        peers_to_close = list(self.peers.values())
-        for sock in peers_to_close:
-            try: sock.shutdown(socket.SHUT_RDWR); sock.close()
-            except OSError: pass
+        for work_queue in self._work_queues: work_queue.put(None)
+        if self._loop_thread is not None:
+            self._wake(); self._loop_thread.join(timeout=5) # The loop closes every socket on its way out
+        elif self.server_socket: self.server_socket.close()
+        self._csv_queue.put(_CSV_STOP); self._csv_thread.join(timeout=5) # Flush registrations still queued for the CSV
         print("Node {} stopped.".format(self.node_id)) # Use format
 
     def _process_message(self, msg_type, data, source_addr, source_sock):
         if msg_type == MSG_TYPE_NEW_TRANSACTION:
-            valid_tx = False
-            if isinstance(data, dict) and 'type' in data:
-                 if data['type'] == TX_TRANSFER_ECASH:
-                      if all(k in data for k in ('from', 'to', 'amount')) and isinstance(data['amount'], int) and data['amount'] > 0: valid_tx = True
-                 else: valid_tx = True
-            if valid_tx:
-                with self.lock:
-                    tx_repr = json.dumps(data, sort_keys=True)
-                    if not any(json.dumps(tx, sort_keys=True) == tx_repr for tx in self.pending_transactions):
-                        should_add = True
-                        if data['type'] == TX_TRANSFER_ECASH and data['from'] != SYSTEM_ACCOUNT:
-                             sender_balance = self.get_current_balance(data['from'])
-                             if sender_balance < data['amount']: print("[Warning] Insufficient balance for pending tx from {}. Tx rejected.".format(data['from'])); should_add = False # Use format
-                        if should_add: self.pending_transactions.append(data); self.broadcast(MSG_TYPE_NEW_TRANSACTION, data, exclude_addr=source_addr)
+            if validate_transaction(data):
+                tx_digest = _tx_digest(data)
+                if not self._is_pending(tx_digest):
+                    should_add = True
+                    if data['type'] is TX_TRANSFER_ECASH and data['from'] != SYSTEM_ACCOUNT:
+                         sender_balance = self.get_current_balance(data['from'])
+                         if sender_balance < data['amount']: print("[Warning] Insufficient balance for pending tx from {}. Tx rejected.".format(data['from'])); should_add = False # Use format
+                    if should_add and self._add_pending(data, tx_digest): self.broadcast(MSG_TYPE_NEW_TRANSACTION, data, exclude_addr=source_addr)
             # else: print("[Warning] Invalid transaction data from {}".format(source_addr)) # Use format
 
         elif msg_type == MSG_TYPE_NEW_BLOCK:
-             if isinstance(data, Block):
-                latest_block = self.blockchain.get_latest_block();
-                if not latest_block and data.index != 0: return
-                valid = True; expected_index = 0 if not latest_block else latest_block.index + 1
-                if data.index != expected_index: valid = False;
-                elif latest_block and data.previous_hash != latest_block.hash: self.request_chain_from_peers(); valid = False
-                elif data.hash != data.calculate_hash(): valid = False
-                else:
-                    temp_balances = self.get_balances_up_to_block(data.previous_hash)
-                    for tx in data.transactions:
-                         if tx.get('type') == TX_TRANSFER_ECASH:
-                              sender, amount = tx.get('from'), tx.get('amount', 0)
-                              if sender != SYSTEM_ACCOUNT and temp_balances.get(sender, 0) < amount: print("[Validation] Block {} invalid: Insufficient funds for tx {}".format(data.index, tx)); valid = False; break # Use format
-                              temp_balances[sender] = temp_balances.get(sender, 0) - amount; recipient = tx.get('to'); temp_balances[recipient] = temp_balances.get(recipient, 0) + amount
-                if valid:
-                    block_added = False; generated_tx = []
-                    with self.lock:
-                        current_latest = self.blockchain.get_latest_block()
-                        if (not current_latest and data.index == 0) or \
-                           (current_latest and data.previous_hash == current_latest.hash and data.index == current_latest.index + 1):
-                             self.blockchain.add_block(data); block_added = True
-                             mined_tx_ids = set(json.dumps(tx, sort_keys=True) for tx in data.transactions)
-                             self.pending_transactions = [ tx for tx in self.pending_transactions if json.dumps(tx, sort_keys=True) not in mined_tx_ids ]
-                             self._update_balances_from_block(data)
-                             print("[Node] Block {} added. Balances updated. Pending tx: {}".format(data.index, len(self.pending_transactions))) # Use format
-                             generated_tx = self._generate_system_transfers_for_block(data)
-                    if block_added:
-                        self.broadcast(MSG_TYPE_NEW_BLOCK, data, exclude_addr=source_addr);
-                        for sys_tx in generated_tx: self.add_transaction_local(sys_tx)
-            # else: print("[Warning] Invalid block data from {}".format(source_addr)) # Use format
+            tip_index, tip_hash = self._tip # One atomic read; stale is fine, the write-locked re-check below decides
+            if data.index <= tip_index: return # Duplicate or old block: dropped without touching any lock
+            if data.index != tip_index + 1 or data.previous_hash != tip_hash: self.request_chain_from_peers(); return # We are behind or forked
+            valid = True
+            if not data.verify_hash(): valid = False
+            elif not data.meets_difficulty(self.blockchain.difficulty): valid = False
+            elif not validate_block_transactions(data): valid = False
+            else:
+                with self.lock.read: temp_balances = defaultdict(int, self.balances) if self._tip[1] == data.previous_hash else None # Parent is the tip, re-checked under the lock
+                if temp_balances is None: return # The tip moved since the pre-check; add_block would refuse the block anyway
+                for tx in data.transactions:
+                     if tx['type'] is TX_TRANSFER_ECASH:
+                          sender, recipient, amount = tx['from'], tx['to'], tx['amount']
+                          if not _transfer_allowed(temp_balances, sender, recipient, amount): print("[Validation] Block {} invalid: Insufficient funds or balance out of range for tx {}".format(data.index, tx)); valid = False; break # Use format
+                          temp_balances[sender] -= amount; temp_balances[recipient] += amount
+            if valid:
+                block_added = False; generated_tx = []
+                with self.lock:
+                    reward_sources = self._add_block(data) # Re-checks that data still extends the tip
+                    if reward_sources is not None:
+                         block_added = True
+                         print("[Node] Block {} added. Balances updated. Pending tx: {}".format(data.index, self.pending_count())) # Use format
+                         generated_tx = self._generate_system_transfers_for_block(data, reward_sources)
+                if block_added:
+                    self.broadcast(MSG_TYPE_NEW_BLOCK, data, exclude_addr=source_addr);
+                    for sys_tx in generated_tx: self.add_transaction_local(sys_tx)
 
         elif msg_type == MSG_TYPE_REQUEST_CHAIN:
-            with self.lock: self.send_message(source_sock, MSG_TYPE_SEND_CHAIN, self.blockchain.chain)
-        elif msg_type == MSG_TYPE_SEND_CHAIN:
-             if isinstance(data, list): self.resolve_conflicts(data)
+            with self.lock.read: self.send_message(source_sock, MSG_TYPE_SEND_CHAIN, self.blockchain.chain.blocks)
+        elif msg_type == MSG_TYPE_SEND_CHAIN: self.resolve_conflicts(data)
         elif msg_type == MSG_TYPE_REQUEST_PEERS:
-             with self.lock: peer_addr_list = list(self.peers.keys()); self.send_message(source_sock, MSG_TYPE_SEND_PEERS, peer_addr_list)
+             self.send_message(source_sock, MSG_TYPE_SEND_PEERS, self.snapshot_peers())
         elif msg_type == MSG_TYPE_SEND_PEERS:
-             if isinstance(data, list):
-                  new_peers_found = 0
-                  for addr in data:
-                       if isinstance(addr, tuple) and len(addr) == 2:
-                            is_self = (addr[0] == self.host and addr[1] == self.port)
-                            if not is_self and addr not in self.peer_addresses_to_connect and addr not in self.peers: self.peer_addresses_to_connect.add(addr); new_peers_found += 1
+             new_peers_found = 0
+             with self._peers_lock:
+                  for addr in data: # decode_message guarantees (host, port) tuples
+                       is_self = (addr[0] == self.host and addr[1] == self.port)
+                       if not is_self and addr not in self.peer_addresses_to_connect and addr not in self.peers: self.peer_addresses_to_connect.add(addr); new_peers_found += 1
 
     # --- Blockchain Management ---
     def add_transaction_local(self, transaction):
-        valid_tx = False
-        if isinstance(transaction, dict) and 'type' in transaction:
-             if transaction['type'] == TX_TRANSFER_ECASH:
-                  if all(k in transaction for k in ('from', 'to', 'amount')) and isinstance(transaction['amount'], int) and transaction['amount'] > 0: valid_tx = True
-             else: valid_tx = True
-        if not valid_tx: print("[Error] Invalid local tx format."); return
+        if not validate_transaction(transaction): print("[Error] Invalid local tx format."); return
         should_add = True
         if transaction['type'] == TX_TRANSFER_ECASH and transaction['from'] != SYSTEM_ACCOUNT:
              sender_balance = self.get_current_balance(transaction['from'])
              if sender_balance < transaction['amount']: print("[Error] Insufficient balance for local tx from {}. ".format(transaction['from'])); should_add = False # Use format
         if should_add:
-             if 'timestamp' not in transaction: transaction['timestamp'] = str(datetime.now())
-             with self.lock:
-                  tx_repr = json.dumps(transaction, sort_keys=True)
-                  if not any(json.dumps(tx, sort_keys=True) == tx_repr for tx in self.pending_transactions):
-                       self.pending_transactions.append(transaction); print("\n[Node] Added local transaction: {}".format(transaction['type'])); self.broadcast(MSG_TYPE_NEW_TRANSACTION, transaction) # Use format
+             if 'timestamp' not in transaction: transaction['timestamp'] = _now_ns()
+             if self._add_pending(transaction, _tx_digest(transaction)):
+                  print("\n[Node] Added local transaction: {}".format(transaction['type'])); self.broadcast(MSG_TYPE_NEW_TRANSACTION, transaction) # Use format
 
     def mine_block_local(self):
         new_block = None; block_added = False; generated_tx = []
         with self.lock:
-            if not self.pending_transactions: print("\n[Node] No pending tx."); return False
+            candidate_entries = self._pending_entries() # (digest, tx) pairs, so mined txs are dropped without re-hashing
+            if not candidate_entries: print("\n[Node] No pending tx."); return False
             print("\n[Node] Mining block #{}...".format(len(self.blockchain.chain))); latest_block = self.blockchain.get_latest_block(); # Use format
             if not latest_block: print("[Error] No Genesis."); return False
-            valid_tx_for_block = []; temp_balances = self.get_balances_up_to_block(latest_block.hash); candidate_txs = list(self.pending_transactions)
-            for tx in candidate_txs:
+            valid_tx_for_block = []; valid_digests = []; temp_balances = defaultdict(int, self.balances) # Mining extends the tip
+            for tx_digest, tx in candidate_entries:
                  valid_for_block = True
-                 if tx.get('type') == TX_TRANSFER_ECASH:
-                      sender, amount = tx.get('from'), tx.get('amount', 0)
-                      if sender != SYSTEM_ACCOUNT and temp_balances.get(sender, 0) < amount: print("[Miner] Skipping pending tx: Insufficient funds {}".format(tx['from'])); valid_for_block = False # Use format
-                      else: temp_balances[sender] = temp_balances.get(sender, 0) - amount; recipient = tx.get('to'); temp_balances[recipient] = temp_balances.get(recipient, 0) + amount
-                 if valid_for_block: valid_tx_for_block.append(tx)
+                 if tx['type'] is TX_TRANSFER_ECASH:
+                      sender, recipient, amount = tx['from'], tx['to'], tx['amount']
+                      if not _transfer_allowed(temp_balances, sender, recipient, amount): print("[Miner] Skipping pending tx: Insufficient funds or balance out of range {}".format(sender)); valid_for_block = False # Use format
+                      else: temp_balances[sender] -= amount; temp_balances[recipient] += amount
+                 if valid_for_block: valid_tx_for_block.append(tx); valid_digests.append(tx_digest)
             if not valid_tx_for_block: print("[Miner] No valid tx for block."); return False
-            new_block = Block( index=latest_block.index + 1, timestamp=datetime.now(), transactions=valid_tx_for_block, previous_hash=latest_block.hash ); new_block.hash = new_block.calculate_hash()
-            if self.blockchain.add_block(new_block):
-                 print("[Node] Mined/Added Block {}.".format(new_block.index)); block_added = True; self._update_balances_from_block(new_block) # Use format
-                 mined_tx_ids = set(json.dumps(tx, sort_keys=True) for tx in valid_tx_for_block)
-                 self.pending_transactions = [ tx for tx in self.pending_transactions if json.dumps(tx, sort_keys=True) not in mined_tx_ids ]
-                 print("[Node] Balances updated. Pending tx: {}".format(len(self.pending_transactions))) # Use format
-                 generated_tx = self._generate_system_transfers_for_block(new_block)
+            new_block = Block( index=latest_block.index + 1, timestamp=datetime.now(), transactions=valid_tx_for_block, previous_hash=latest_block.hash ); new_block.mine(self.blockchain.difficulty)
+            new_block._tx_digests = tuple(valid_digests)
+            reward_sources = self._add_block(new_block)
+            if reward_sources is not None:
+                 print("[Node] Mined/Added Block {}.".format(new_block.index)); block_added = True # Use format
+                 print("[Node] Balances updated. Pending tx: {}".format(self.pending_count())) # Use format
+                 generated_tx = self._generate_system_transfers_for_block(new_block, reward_sources)
         if block_added and new_block:
             self.broadcast(MSG_TYPE_NEW_BLOCK, new_block);
             for sys_tx in generated_tx: self.add_transaction_local(sys_tx)
@@ -285,9 +659,8 @@ class Node:
         with self.lock:
             current_len = len(self.blockchain.chain); received_len = len(received_chain)
             if received_len > current_len:
-                temp_blockchain = Blockchain(); temp_blockchain.chain = received_chain
-                if temp_blockchain.is_chain_valid() and self._validate_chain_balances(received_chain):
-                    print("[Sync] Received chain valid (len {}). Replacing.".format(received_len)); self.blockchain.chain = received_chain # Use format
+                if self.blockchain.is_chain_valid(received_chain) and self._validate_chain_balances(received_chain):
+                    print("[Sync] Received chain valid (len {}). Replacing.".format(received_len)); self.blockchain.replace_chain(received_chain) # Use format
                     self._reconcile_pending_transactions(); self._recalculate_all_balances(); replaced = True
         return replaced
 
@@ -297,101 +670,122 @@ class Node:
         time.sleep(10); self.request_chain_from_peers()
     def _reconcile_pending_transactions(self):
         all_tx_in_chain = set();
-        for block in self.blockchain.chain:
-             for tx in block.transactions: all_tx_in_chain.add(json.dumps(tx, sort_keys=True))
-        self.pending_transactions = [ tx for tx in self.pending_transactions if json.dumps(tx, sort_keys=True) not in all_tx_in_chain ]
+        for block in self.blockchain.chain: all_tx_in_chain.update(block.tx_digests)
+        self._drop_pending(all_tx_in_chain)
+
+    # --- Mempool (striped across _tx_shards; each shard lock is a leaf lock, never held while taking self.lock) ---
+    def _shard(self, tx_digest): return self._tx_shards[tx_digest[0] % PENDING_SHARDS]
+    def _is_pending(self, tx_digest):
+        shard_lock, entries = self._shard(tx_digest)
+        with shard_lock: return tx_digest in entries
+    def _add_pending(self, tx, tx_digest):
+        """ Adds tx unless already pending; returns True if it was added. """
+        shard_lock, entries = self._shard(tx_digest)
+        with shard_lock:
+             if tx_digest in entries: return False
+             entries[tx_digest] = (next(self._pending_seq), tx); return True
+    def _drop_pending(self, digests):
+        """ Removes pending txs whose digest is in digests, one shard at a time. """
+        for shard_lock, entries in self._tx_shards:
+             with shard_lock:
+                  for tx_digest in [d for d in entries if d in digests]: del entries[tx_digest]
+    def _pending_entries(self):
+        """ Arrival-ordered (digest, tx) copy of the mempool; each shard is locked only while it is copied. """
+        merged = []
+        for shard_lock, entries in self._tx_shards:
+             with shard_lock: merged.extend((seq, tx_digest, tx) for tx_digest, (seq, tx) in entries.items())
+        merged.sort(key=lambda entry: entry[0])
+        return [(tx_digest, tx) for _, tx_digest, tx in merged]
+    @property
+    def pending_transactions(self): return [tx for _, tx in self._pending_entries()]
+    def pending_count(self): return sum(len(entries) for _, entries in self._tx_shards)
 
     # --- Balance and Ledger Logic ---
-    def _update_balances_from_block(self, block):
-        with self.lock:
-             for tx in block.transactions:
-                  if tx.get('type') == TX_TRANSFER_ECASH:
-                       sender, recipient, amount = tx.get('from'), tx.get('to'), tx.get('amount', 0)
-                       if sender not in E_CASH_BALANCES: E_CASH_BALANCES[sender] = 0
-                       if recipient not in E_CASH_BALANCES: E_CASH_BALANCES[recipient] = 0
-                       E_CASH_BALANCES[sender] -= amount; E_CASH_BALANCES[recipient] += amount
+    @staticmethod
+    def _apply_transfer(balances, tx):
+        sender, recipient, amount = tx['from'], tx['to'], tx['amount'] # validate_transaction guarantees these
+        balances[sender] -= amount; balances[recipient] += amount
+    def _close_block(self, block):
+        """ Publishes block as the tip (self.balances already holds the balances after it). """
+        self._tip = (block.index, block.hash)
+    def _add_block(self, block):
+        """
+        Appends a validated block (write lock held). The single pass that stages its index entries also collects its
+        transfers, mined digests and the txs that may earn rewards; balances are only touched once the
+        chain has accepted the block, so a failure part-way leaves every structure as it was.
+        Returns the reward txs, or None if the block no longer extends the tip.
+        """
+        transfers = []; reward_sources = []; digests = [] if block._tx_digests is None else None
+        def collect(tx):
+            if digests is not None: digests.append(_tx_digest(tx))
+            tx_type = tx['type']
+            if tx_type is TX_TRANSFER_ECASH: transfers.append(tx)
+            elif tx_type is TX_LAB_TEST_RESULT or tx_type is TX_PRESCRIPTION_FILLED: reward_sources.append(tx)
+        if not self.blockchain.add_block(block, on_tx=collect): return None
+        for tx in transfers: self._apply_transfer(self.balances, tx)
+        if digests is not None: block._tx_digests = tuple(digests)
+        self._close_block(block); self._drop_pending(set(block._tx_digests))
+        return reward_sources
     def _recalculate_all_balances(self):
         print("[Balance] Recalculating all balances...");
         with self.lock:
-             temp_balances = {user: 0 for user in USERS}; temp_balances[SYSTEM_ACCOUNT] = INITIAL_SYSTEM_BALANCE
-             chain_copy = list(self.blockchain.chain)
-             for block in chain_copy:
+             balances = _initial_balances() # Rebuilt in a local: the lock-free _tip must not step through every block
+             for block in self.blockchain.chain:
                   for tx in block.transactions:
-                       if tx.get('type') == TX_TRANSFER_ECASH:
-                            sender, recipient, amount = tx.get('from'), tx.get('to'), tx.get('amount',0)
-                            if sender not in temp_balances: temp_balances[sender] = 0
-                            if recipient not in temp_balances: temp_balances[recipient] = 0
-                            temp_balances[sender] -= amount; temp_balances[recipient] += amount
-             global E_CASH_BALANCES; E_CASH_BALANCES = temp_balances
+                       if tx['type'] is TX_TRANSFER_ECASH: self._apply_transfer(balances, tx)
+             self.balances = balances; self._close_block(self.blockchain.get_latest_block()) # Published once, at the tip
         print("[Balance] Recalculation complete.")
     def get_current_balance(self, username):
-        temp_balances = self._get_balances_from_chain(); return temp_balances.get(username, 0)
-    def get_balances_up_to_block(self, block_hash):
-         balances = {user: 0 for user in USERS}; balances[SYSTEM_ACCOUNT] = INITIAL_SYSTEM_BALANCE
-         with self.lock:
-              chain_copy = list(self.blockchain.chain)
-              for block in chain_copy:
-                   for tx in block.transactions:
-                        if tx.get('type') == TX_TRANSFER_ECASH:
-                             sender, recipient, amount = tx.get('from'), tx.get('to'), tx.get('amount',0)
-                             if sender not in balances: balances[sender] = 0;
-                             if recipient not in balances: balances[recipient] = 0
-                             balances[sender] -= amount; balances[recipient] += amount
-                   if block.hash == block_hash: break
-         return balances
+        with self.lock.read: return self.balances.get(username, 0) # .get: a lookup must not insert into the defaultdict
+    def cached_patient_history(self, patient_id):
+        """
+        get_patient_history() memoized until the next block or chain replacement (both move the tip hash).
+        The returned list is shared between callers: read it, do not mutate it.
+        """
+        with self.lock.read:
+            tip_hash = self._tip[1]; cache_tip, histories = self._history_cache
+            if cache_tip != tip_hash: histories = {}; self._history_cache = (tip_hash, histories)
+            history = histories.get(patient_id)
+            if history is None: history = histories[patient_id] = self.blockchain.get_patient_history(patient_id)
+            return history
     def _get_balances_from_chain(self):
-        balances = {user: 0 for user in USERS}; balances[SYSTEM_ACCOUNT] = INITIAL_SYSTEM_BALANCE
-        with self.lock:
-             chain_copy = list(self.blockchain.chain)
-             for block in chain_copy:
-                  for tx in block.transactions:
-                       if tx.get('type') == TX_TRANSFER_ECASH:
-                            sender, recipient, amount = tx.get('from'), tx.get('to'), tx.get('amount',0)
-                            if sender not in balances: balances[sender] = 0;
-                            if recipient not in balances: balances[recipient] = 0
-                            balances[sender] -= amount; balances[recipient] += amount
-        return balances
+        with self.lock.read: return dict(self.balances)
     def _validate_chain_balances(self, chain):
-        temp_balances = {user: 0 for user in USERS}; temp_balances[SYSTEM_ACCOUNT] = INITIAL_SYSTEM_BALANCE
+        """ Replays a received chain's transfers in one ledger scan; False if any non-system sender overdraws. """
+        ledger = TransferLedger()
         for block in chain:
-             current_block_balances = temp_balances.copy()
-             for tx in block.transactions:
-                  if tx.get('type') == TX_TRANSFER_ECASH:
-                       sender, amount = tx.get('from'), tx.get('amount', 0)
-                       if sender != SYSTEM_ACCOUNT and current_block_balances.get(sender, 0) < amount: print("[Chain Validation] Invalid transfer in block {}: {}".format(block.index, tx)); return False # Use format
-                       current_block_balances[sender] = current_block_balances.get(sender, 0) - amount
-                       recipient = tx.get('to'); current_block_balances[recipient] = current_block_balances.get(recipient, 0) + amount
-             temp_balances = current_block_balances
+             if not validate_block_transactions(block): print("[Chain Validation] Malformed transactions in block {}".format(block.index)); return False # Use format
+             ledger.append_block(block)
+        _, overdraft = ledger.scan(check_funds=True)
+        if overdraft >= 0:
+             block = chain[bisect.bisect_right(ledger.block_ends, overdraft)]
+             print("[Chain Validation] Invalid transfer in block {}: {} -> {} ({})".format(block.index, ledger.users[ledger.senders[overdraft]], ledger.users[ledger.recipients[overdraft]], ledger.amounts[overdraft])) # Use format
+             return False
         return True
-    def _generate_system_transfers_for_block(self, block):
+    def _generate_system_transfers_for_block(self, block, reward_sources=None):
+        """
+        Reward transfers for a just-added block, resolved through the chain's patient and prescription indexes.
+        reward_sources: the block's lab result and fill txs, as collected by _add_block (default: scan the block).
+        """
         generated_tx = [];
-        with self.lock: chain_history_copy = list(self.blockchain.chain)
-        def get_history_from_copy(patient_id, chain_copy):
-             history = [];
-             for b in chain_copy:
-                  if b.index > block.index: continue
-                  for t in b.transactions:
-                       if isinstance(t, dict) and t.get('patient_id') == patient_id: history.append({'transaction': t})
-             return history
-        for tx in block.transactions:
-             if not isinstance(tx, dict): continue; patient_id = tx.get('patient_id');
-             if not patient_id: continue
-             if tx.get('type') == 'LAB_TEST_RESULT':
-                  history = get_history_from_copy(patient_id, chain_history_copy); ordering_doctor = None
-                  for record in reversed(history):
-                       prev_tx = record['transaction']
-                       if (prev_tx.get('type') == 'DOCTOR_CONSULTATION' and tx.get('test_name') in prev_tx.get('tests_ordered', []) and prev_tx.get('patient_id') == patient_id): ordering_doctor = prev_tx.get('doctor'); break
-                  if ordering_doctor:
-                       reward_tx = {"type": TX_TRANSFER_ECASH, "from": SYSTEM_ACCOUNT, "to": ordering_doctor, "amount": 500, "reason": "Reward for Lab Test Order ({})".format(tx.get('test_name')), "timestamp": str(datetime.now())} # Use format
-                       generated_tx.append(reward_tx); print("[Reward Gen] System -> {} (500 units) for test in block {}".format(ordering_doctor, block.index)) # Use format
-             elif tx.get('type') == 'PRESCRIPTION_FILLED':
-                  ref_ts = tx.get('references_prescription_timestamp'); prescribing_doctor = None; history = get_history_from_copy(patient_id, chain_history_copy)
-                  for record in reversed(history):
-                       prev_tx = record['transaction']
-                       if (prev_tx.get('type') == 'PRESCRIPTION' and prev_tx.get('timestamp') == ref_ts and prev_tx.get('patient_id') == patient_id): prescribing_doctor = prev_tx.get('prescribed_by'); break
-                  if prescribing_doctor:
-                       reward_tx = {"type": TX_TRANSFER_ECASH, "from": SYSTEM_ACCOUNT, "to": prescribing_doctor, "amount": 700, "reason": "Reward for Prescription Fill", "timestamp": str(datetime.now())}
-                       generated_tx.append(reward_tx); print("[Reward Gen] System -> {} (700 units) for fill in block {}".format(prescribing_doctor, block.index)) # Use format
+        with self.lock.read:
+             for tx in (block.transactions if reward_sources is None else reward_sources):
+                  patient_id = tx.get('patient_id')
+                  if not patient_id: continue
+                  if tx['type'] is TX_LAB_TEST_RESULT:
+                       ordering_doctor = None
+                       for block_index, prev_tx in self.blockchain.iter_patient_history_reverse(patient_id):
+                            if block_index > block.index: continue
+                            if prev_tx['type'] is TX_DOCTOR_CONSULTATION and tx.get('test_name') in prev_tx.get('tests_ordered', []): ordering_doctor = prev_tx.get('doctor'); break
+                       if ordering_doctor:
+                            reward_tx = {"type": TX_TRANSFER_ECASH, "from": SYSTEM_ACCOUNT, "to": ordering_doctor, "amount": 500, "reason": "Reward for Lab Test Order ({})".format(tx.get('test_name')), "timestamp": _now_ns()} # Use format
+                            generated_tx.append(reward_tx); print("[Reward Gen] System -> {} (500 units) for test in block {}".format(ordering_doctor, block.index)) # Use format
+                  elif tx['type'] is TX_PRESCRIPTION_FILLED:
+                       prescription = self.blockchain.get_prescription(patient_id, tx.get('references_prescription_timestamp'))
+                       prescribing_doctor = prescription.get('prescribed_by') if prescription else None
+                       if prescribing_doctor:
+                            reward_tx = {"type": TX_TRANSFER_ECASH, "from": SYSTEM_ACCOUNT, "to": prescribing_doctor, "amount": 700, "reason": "Reward for Prescription Fill", "timestamp": _now_ns()}
+                            generated_tx.append(reward_tx); print("[Reward Gen] System -> {} (700 units) for fill in block {}".format(prescribing_doctor, block.index)) # Use format
         return generated_tx
 
     # --- User Interface Methods ---
@@ -407,63 +801,92 @@ class Node:
     def view_balances(self):
         """ Displays ledger balances from the local cache. """
         print("\n--- Ledger Balances (e-cash units) ---")
-        with self.lock:
-             sorted_users = sorted(E_CASH_BALANCES.keys())
+        with self.lock.read:
+             sorted_users = sorted(self.balances.keys())
              # --- FIXED LINE ---
              for user in sorted_users:
                  # Use .format() instead of f-string
-                 print("{}: {}".format(user, E_CASH_BALANCES.get(user, 0)))
+                 print("{}: {}".format(user, self.balances[user]))
              # --- END FIX ---
         print("------------------------------------")
 
     def view_patient_history(self, patient_id):
         print("\n--- Patient History for ID: {} (Node {}) ---".format(patient_id, self.node_id)) # Use format
-        with self.lock: history = self.blockchain.get_patient_history(patient_id)
+        history = self.cached_patient_history(patient_id)
         if not history: print("No records found..."); return
         for record in history:
              print("\nBlock #{} ({})".format(record['block_index'], record['timestamp'])) # Use format
-             try: print(json.dumps(record['transaction'], indent=2))
+             try: print(pretty_json(display_tx(record['transaction'])))
              except TypeError: print(str(record['transaction']))
         print("-" * 30)
 
+    # --- Patient CSV ---
+    def _open_patient_csv(self):
+        write_header = not os.path.exists(PATIENT_CSV_FILENAME) or os.path.getsize(PATIENT_CSV_FILENAME) == 0
+        csvfile = open(PATIENT_CSV_FILENAME, 'a', newline='', buffering=CSV_BUFFER_BYTES); writer = csv.writer(csvfile)
+        if write_header: writer.writerow(PATIENT_CSV_HEADER)
+        return csvfile, writer
+
+    def _csv_writer(self):
+        """
+        Sole writer of the patient CSV. Keeps the file open (opened on the first row) and group-commits:
+        queued rows are written with one writerows + flush + fsync per CSV_BATCH_ROWS rows or CSV_BATCH_SECONDS.
+        """
+        csvfile = writer = None; batch = []; deadline = 0.0
+        while True:
+            try: row = self._csv_queue.get(timeout=max(0.0, deadline - time.monotonic()) if batch else None)
+            except queue.Empty: row = None # Batch deadline reached
+            if row is not None and row is not _CSV_STOP:
+                if not batch: deadline = time.monotonic() + CSV_BATCH_SECONDS
+                batch.append(row)
+                if len(batch) < CSV_BATCH_ROWS: continue
+            if batch:
+                try:
+                    if csvfile is None: csvfile, writer = self._open_patient_csv()
+                    writer.writerows(batch); csvfile.flush(); os.fsync(csvfile.fileno())
+                except (IOError, OSError) as e:
+                    print("[Error] Could not write {} rows to CSV file {}: {}".format(len(batch), PATIENT_CSV_FILENAME, e)) # Use format
+                    if csvfile is not None:
+                        try: csvfile.close()
+                        except (IOError, OSError): pass
+                    csvfile = writer = None # Reopen on the next batch
+                batch = []
+            if row is _CSV_STOP: break
+        if csvfile is not None: csvfile.close()
+
     # --- Workflow Actions ---
     def register_new_patient(self, patient_name):
         if not self.current_user or self.current_user['role'] != 'doctor': return None, "Permission denied."
-        patient_id = str(uuid.uuid4()); timestamp = str(datetime.now()); registered_by = self.current_user['username']
-        transaction = { "type": "PATIENT_REGISTRATION", "patient_id": patient_id, "patient_name": patient_name, "registered_by": registered_by, "timestamp": timestamp }
-        # Write to CSV
-        write_header = not os.path.exists(PATIENT_CSV_FILENAME)
-        try:
-            with self.csv_lock:
-                 with open(PATIENT_CSV_FILENAME, 'a', newline='') as csvfile:
-                      writer = csv.writer(csvfile)
-                      if write_header: writer.writerow(PATIENT_CSV_HEADER)
-                      writer.writerow([patient_id, patient_name, registered_by, timestamp])
-                 print("[CSV] Patient {} details logged to {}".format(patient_name, PATIENT_CSV_FILENAME)) # Use format
-        except IOError as e: print("[Error] Could not write to CSV file {}: {}".format(PATIENT_CSV_FILENAME, e)) # Use format
+        patient_id = str(uuid.uuid4()); registered_by = self.current_user['username']
+        transaction = { "type": TX_PATIENT_REGISTRATION, "patient_id": patient_id, "patient_name": patient_name, "registered_by": registered_by, "timestamp": _now_ns() }
+        # Queue for the CSV writer thread (group-committed with other registrations). The timestamp column is the tx's own
+        # value rendered readably; rows join to the chain by patient_id.
+        self._csv_queue.put([patient_id, patient_name, registered_by, iso(transaction['timestamp'])])
+        print("[CSV] Patient {} details queued for {}".format(patient_name, PATIENT_CSV_FILENAME)) # Use format
         self.add_transaction_local(transaction)
-        return patient_id, "Registration tx created for {} (ID: {}) and logged to CSV.".format(patient_name, patient_id) # Use format
+        return patient_id, "Registration tx created for {} (ID: {}) and queued for the patient CSV.".format(patient_name, patient_id) # Use format
 
     def doctor_consultation(self, patient_id, notes, order_test_flag):
         if not self.current_user or self.current_user['role'] != 'doctor': return "Permission denied."
         if not patient_id: return "No active patient selected."
-        transaction = { "type": "DOCTOR_CONSULTATION", "patient_id": patient_id, "doctor": self.current_user['username'], "notes": notes, "tests_ordered": ["Blood Test"] if order_test_flag else [], "timestamp": str(datetime.now()) }
+        transaction = { "type": TX_DOCTOR_CONSULTATION, "patient_id": patient_id, "doctor": self.current_user['username'], "notes": notes, "tests_ordered": ["Blood Test"] if order_test_flag else [], "timestamp": _now_ns() }
         self.add_transaction_local(transaction); return "Consultation transaction created."
     def perform_blood_test(self, patient_id, results_dict):
         if not self.current_user or self.current_user['role'] != 'lab': return "Permission denied."
         if not patient_id: return "No active patient selected."
-        transaction = { "type": "LAB_TEST_RESULT", "patient_id": patient_id, "test_name": "Blood Test", "performed_by": self.current_user['username'], "results": results_dict, "timestamp": str(datetime.now()) }
+        transaction = { "type": TX_LAB_TEST_RESULT, "patient_id": patient_id, "test_name": "Blood Test", "performed_by": self.current_user['username'], "results": results_dict, "timestamp": _now_ns() }
         self.add_transaction_local(transaction); return "Blood test result transaction created."
     def doctor_review_results_and_prescribe(self, patient_id, prescription_details, reviewed_lab_user):
         if not self.current_user or self.current_user['role'] != 'doctor': return "Permission denied."
         if not patient_id: return "No active patient selected."
-        doctor_user = self.current_user['username']; payment_amount = 100; doctor_balance = self.get_current_balance(doctor_user); transfer_possible = False
+        doctor_user = self.current_user['username']; payment_amount = 100; now_ts = _now_ns() # One review: both txs share its timestamp
+        doctor_balance = self.get_current_balance(doctor_user); transfer_possible = False
         if doctor_balance >= payment_amount: transfer_possible = True
         else: print("[Warning] Doctor {} has insufficient funds ({}) to pay lab ({}).".format(doctor_user, doctor_balance, payment_amount)) # Use format
-        presc_tx = { "type": "PRESCRIPTION", "patient_id": patient_id, "prescribed_by": doctor_user, **prescription_details, "based_on_review_of_test_by": reviewed_lab_user, "timestamp": str(datetime.now()) }
+        presc_tx = { "type": TX_PRESCRIPTION, "patient_id": patient_id, "prescribed_by": doctor_user, **prescription_details, "based_on_review_of_test_by": reviewed_lab_user, "timestamp": now_ts }
         self.add_transaction_local(presc_tx); final_msg = "Prescription transaction created. "
         if transfer_possible and reviewed_lab_user:
-            transfer_tx = { "type": TX_TRANSFER_ECASH, "from": doctor_user, "to": reviewed_lab_user, "amount": payment_amount, "reason": "Payment for Lab Report Access", "timestamp": str(datetime.now()) }
+            transfer_tx = { "type": TX_TRANSFER_ECASH, "from": doctor_user, "to": reviewed_lab_user, "amount": payment_amount, "reason": "Payment for Lab Report Access", "timestamp": now_ts }
             self.add_transaction_local(transfer_tx); final_msg += "Payment transaction ({} units to {}) created.".format(payment_amount, reviewed_lab_user) # Use format
         elif not reviewed_lab_user: final_msg += "(Could not identify lab user for payment)."
         else: final_msg += "(Payment skipped due to insufficient funds)."
@@ -471,10 +894,104 @@ class Node:
     def pharmacy_fill_prescription(self, patient_id, prescription_timestamp):
         if not self.current_user or self.current_user['role'] != 'pharmacy': return "Permission denied."
         if not patient_id: return "No active patient selected."
-        transaction = { "type": "PRESCRIPTION_FILLED", "patient_id": patient_id, "filled_by_pharmacy": self.current_user['username'], "references_prescription_timestamp": prescription_timestamp, "timestamp": str(datetime.now()) }
+        transaction = { "type": TX_PRESCRIPTION_FILLED, "patient_id": patient_id, "filled_by_pharmacy": self.current_user['username'], "references_prescription_timestamp": prescription_timestamp, "timestamp": _now_ns() }
         self.add_transaction_local(transaction); return "Prescription filled transaction created."
 
+# --- CLI Helpers (shared REPL for the role-specific node scripts) ---
+CLI_EXIT = object() # Returned by a command handler to leave the REPL
+CLI_DEBUG = bool(os.environ.get('DEBUG') or os.environ.get('PHARMACY_DEBUG')) # Full tracebacks for CLI errors (read once at import)
+
+class CliSession:
+    """ Per-REPL state: the node, the role it serves, the active patient and the cached prompt prefix. """
+    def __init__(self, node, label, role, role_name, help_text):
+        self.node = node
+        self.label = label # Prompt prefix shown while logged out, e.g. "Doc"
+        self.role = role
+        self.role_name = role_name
+        self.help_text = help_text
+        self.patient_id = None
+        self.refresh_prompt()
+
+    def refresh_prompt(self):
+        """ "<user or label>@<node_id>"; only changes on login/logout, so it is cached between commands. """
+        user = self.node.current_user
+        self.base_prompt = "{}@{}".format(user['username'] if user else self.label, self.node.node_id) # Use format
+
+def _cmd_exit(session, command_parts): return CLI_EXIT
+def _cmd_help(session, command_parts): print(session.help_text)
+def _cmd_login(session, command_parts):
+    node = session.node
+    if node.current_user: print("Already logged in."); return
+    username = input("Enter username: ")
+    password = input("Enter password: ")
+    user_info = node.login(username, password)
+    if user_info and user_info['role'] != session.role: print("Error: This user is not a {}.".format(session.role_name)); node.logout() # Use format
+    session.refresh_prompt()
+def _cmd_logout(session, command_parts):
+    session.node.logout(); session.patient_id = None; session.refresh_prompt()
+def _cmd_chain(session, command_parts): print(Blockchain.format_chain(session.node.snapshot_chain()))
+def _cmd_pending(session, command_parts): print("Pending Transactions: {}".format(pretty_json([display_tx(tx) for tx in session.node.snapshot_pending()]))) # Use format
+def _cmd_peers(session, command_parts): print("Connected Peers: {}".format(session.node.snapshot_peers())) # Use format
+
+# Commands available to every node regardless of login
+COMMON_COMMANDS = {
+    "exit": _cmd_exit,
+    "help": _cmd_help,
+    "login": _cmd_login,
+    "logout": _cmd_logout,
+    "mine": lambda session, command_parts: session.node.mine_block_local(),
+    "chain": _cmd_chain,
+    "pending": _cmd_pending,
+    "peers": _cmd_peers,
+    "balances": lambda session, command_parts: session.node.view_balances(),
+    "sync": lambda session, command_parts: session.node.request_chain_from_peers(),
+    "recalc_balances": lambda session, command_parts: session.node._recalculate_all_balances(),
+}
+
+# Patient-context commands shared by the role tables
+def cli_set_patient(session, command_parts):
+    if len(command_parts) < 2: print("Usage: set_patient <id>"); return
+    session.patient_id = command_parts[1].split()[0] # First token only; the REPL leaves the rest of the line unsplit
+    print("Active patient set to: {}".format(session.patient_id)) # Use format
+def cli_history(session, command_parts):
+    if session.patient_id: session.node.view_patient_history(session.patient_id)
+    else: print("No active patient set.")
+
+def cli_lines(make_prompt):
+    """
+    Command lines for a REPL. On a TTY: input(make_prompt()). Piped/scripted stdin: plain iteration over sys.stdin,
+    with no prompt and none of input()'s per-call flushing. Ends at EOF either way.
+    """
+    if sys.stdin.isatty():
+        while True:
+            try: yield input(make_prompt())
+            except EOFError: return
+    else: yield from sys.stdin
+
+def run_cli(session, role_commands):
+    """ REPL loop: O(1) dict dispatch over COMMON_COMMANDS, then the role's table (requires that role's login). """
+    for line in cli_lines(lambda: "{} ({}): ".format(session.base_prompt, session.patient_id or 'No Patient')): # Use format
+        try:
+            user_input = line.strip()
+            if not user_input: continue
+            command_parts = user_input.split(maxsplit=1) # Only the command word is inspected; keep the rest intact
+            command = command_parts[0].lower()
+            handler = COMMON_COMMANDS.get(command)
+            if handler is None:
+                handler = role_commands.get(command)
+                if handler is None: print("Unknown command."); continue
+                user = session.node.current_user
+                if not user or user['role'] != session.role: print("Command requires {} login.".format(session.role_name)); continue # Use format
+            if handler(session, command_parts) is CLI_EXIT: break
+        except EOFError: break
+        except Exception as e:
+            print("\nAn error occurred: {}: {}".format(type(e).__name__, e)) # Use format
+            if CLI_DEBUG: traceback.print_exc() # Full tracebacks are opt-in (DEBUG=1 or PHARMACY_DEBUG=1)
+
 # --- Helper Function for Argument Parsing ---
+# One "host:port" entry of --peers, anchored to the commas so a malformed entry is skipped as a whole
+_PEER_RE = re.compile(r'(?:^|,)\s*([^:,\s]+):(\d+)\s*(?=,|$)')
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Run a Healthcare Blockchain Node")
     parser.add_argument("--host", type=str, default="127.0.0.1", help="Host IP")
@@ -482,9 +999,5 @@ def parse_arguments():
     parser.add_argument("--peers", type=str, default="", help="Comma-separated peers (host:port)")
     parser.add_argument("--id", type=str, help="Optional node ID")
     args = parser.parse_args()
-    peer_list = []
-    if args.peers:
-        for peer_str in args.peers.split(','):
-            try: host, port_str = peer_str.strip().split(':'); peer_list.append((host, int(port_str)))
-            except ValueError: pass
+    peer_list = [(host, int(port_str)) for host, port_str in _PEER_RE.findall(args.peers)]
     return args.host, args.port, peer_list, args.id
\ No newline at end of file
@@ -1,92 +1,52 @@
 # pharmacy_node.py
 
-import sys
-import json
-import traceback
-from node_common import Node, parse_arguments
+from node_common import Node, parse_arguments, CliSession, run_cli, cli_set_patient, cli_history, iso, TX_PRESCRIPTION, TX_PRESCRIPTION_FILLED
+
+HELP_TEXT = """
+Available Commands:
+  login                   Login as pharmacist
+  logout                  Logout
+  fill                    Fill prescription (needs active patient)
+  set_patient <id>        Set active patient
+  history                 View history for active patient
+  mine                    Mine pending transactions
+  chain                   View local blockchain
+  pending                 View pending transactions
+  peers                   View connected peers
+  balances                View e-cash balances (Ledger View)
+  sync                    Request chain sync from peers
+  recalc_balances         Recalculate balances from chain
+  exit                    Stop the node"""
+
+# --- Pharmacy Specific Commands ---
+def _cmd_fill(session, command_parts):
+    node, active_patient_id = session.node, session.patient_id
+    if not active_patient_id: print("No active patient set."); return
+    print("Searching for unfilled prescription...")
+    latest_prescription_tx = None; already_filled_timestamps = set()
+    # One lazy newest-first pass over the patient index (no history list is built): a fill is always recorded after its
+    # prescription, so every fill of a prescription has been seen by the time the prescription itself is reached.
+    with node.lock.read:
+         for _, tx in node.blockchain.iter_patient_history_reverse(active_patient_id):
+              if tx['type'] is TX_PRESCRIPTION_FILLED: already_filled_timestamps.add(tx.get('references_prescription_timestamp'))
+              elif tx['type'] is TX_PRESCRIPTION and tx.get('timestamp') not in already_filled_timestamps: latest_prescription_tx = tx; break
+    if latest_prescription_tx:
+         print("Found unfilled: {} from {}".format(latest_prescription_tx.get('medication'), iso(latest_prescription_tx.get('timestamp')))) # Use format
+         confirm = input("Dispense {}? (y/n): ".format(latest_prescription_tx.get('medication'))).lower() # Use format
+         if confirm == 'y': msg = node.pharmacy_fill_prescription(active_patient_id, latest_prescription_tx.get('timestamp')); print(msg)
+         else: print("Dispensing cancelled.")
+    else: print("No unfilled prescriptions found.")
+
+PHARMACY_COMMANDS = {
+    "fill": _cmd_fill,
+    "set_patient": cli_set_patient,
+    "history": cli_history,
+}
 
 def run_pharmacy_interface(node):
-    active_patient_id = None
     print("\n--- Pharmacy Node Interface ---")
     print("Type 'help' for commands.")
-    while True:
-        prompt = "Pharm@{} ({}): ".format(node.node_id, active_patient_id or 'No Patient') # Use format
-        if node.current_user:
-            prompt = "{}@{} ({}): ".format(node.current_user['username'], node.node_id, active_patient_id or 'No Patient') # Use format
-        try:
-            user_input = input(prompt).strip()
-            if not user_input: continue
-            command_parts = user_input.split()
-            command = command_parts[0].lower()
-
-            if command == "exit": break
-            elif command == "help":
-                print("\nAvailable Commands:")
-                print("  login                   Login as pharmacist")
-                print("  logout                  Logout")
-                print("  fill                    Fill prescription (needs active patient)")
-                print("  set_patient <id>        Set active patient")
-                print("  history                 View history for active patient")
-                print("  mine                    Mine pending transactions")
-                print("  chain                   View local blockchain")
-                print("  pending                 View pending transactions")
-                print("  peers                   View connected peers")
-                print("  balances                View e-cash balances (Ledger View)")
-                print("  sync                    Request chain sync from peers")
-                print("  recalc_balances         Recalculate balances from chain")
-                print("  exit                    Stop the node")
-
-            elif command == "login":
-                if not node.current_user:
-                    username = input("Enter username: ")
-                    password = input("Enter password: ")
-                    user_info = node.login(username, password)
-                    if user_info and user_info['role'] != 'pharmacy': print("Error: User not a pharmacist."); node.logout()
-                else: print("Already logged in.")
-            elif command == "logout": node.logout(); active_patient_id = None
-            elif command == "mine": node.mine_block_local()
-            elif command == "chain":
-                 with node.lock: print(node.blockchain)
-            elif command == "pending":
-                 with node.lock: print("Pending Transactions: {}".format(json.dumps(node.pending_transactions, indent=2))) # Use format
-            elif command == "peers":
-                 with node.lock: print("Connected Peers: {}".format(list(node.peers.keys()))) # Use format
-            elif command == "balances": node.view_balances()
-            elif command == "sync": node.request_chain_from_peers()
-            elif command == "recalc_balances": node._recalculate_all_balances()
-
-            # --- Pharmacy Specific Commands ---
-            elif node.current_user and node.current_user['role'] == 'pharmacy':
-                if command == "set_patient" and len(command_parts) > 1:
-                     active_patient_id = command_parts[1]; print("Active patient set to: {}".format(active_patient_id)) # Use format
-                elif command == "history":
-                     if active_patient_id: node.view_patient_history(active_patient_id)
-                     else: print("No active patient set.")
-                elif command == "fill":
-                     if active_patient_id:
-                          print("Searching for unfilled prescription...")
-                          latest_prescription_tx = None; already_filled_timestamps = set()
-                          with node.lock: history = node.blockchain.get_patient_history(active_patient_id)
-                          for record in history:
-                               tx = record['transaction']
-                               if tx.get('type') == 'PRESCRIPTION_FILLED': already_filled_timestamps.add(tx.get('references_prescription_timestamp'))
-                          for record in reversed(history):
-                               tx = record['transaction']
-                               if tx.get('type') == 'PRESCRIPTION':
-                                    ts = tx.get('timestamp')
-                                    if ts not in already_filled_timestamps: latest_prescription_tx = tx; print("Found unfilled: {} from {}".format(tx.get('medication'), ts)); break # Use format
-                          if latest_prescription_tx:
-                               confirm = input("Dispense {}? (y/n): ".format(latest_prescription_tx.get('medication'))).lower() # Use format
-                               if confirm == 'y': msg = node.pharmacy_fill_prescription(active_patient_id, latest_prescription_tx.get('timestamp')); print(msg)
-                               else: print("Dispensing cancelled.")
-                          else: print("No unfilled prescriptions found.")
-                     else: print("No active patient set.")
-                else: print("Unknown command or requires login.")
-            elif command in ["fill", "set_patient", "history"]: print("Command requires pharmacist login.")
-            else: print("Unknown command.")
-
-        except EOFError: break
-        except Exception as e: print("\nAn error occurred: {}".format(e)); traceback.print_exc() # Use format
+    run_cli(CliSession(node, "Pharm", "pharmacy", "pharmacist", HELP_TEXT), PHARMACY_COMMANDS)
 
 def main():
     host, port, peer_list, node_id = parse_arguments()
@@ -98,4 +58,4 @@ def main():
     finally: node.stop(); print("Pharmacy Node shutdown complete.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,32 +1,101 @@
 # secure_crypto.py
-# Implements secure AES-CBC and AES-CTR encryption/decryption
-# Uses random IV/Nonce per message and handles padding errors via ValueError
+# Implements AES-GCM (authenticated, preferred) and legacy AES-CBC / AES-CTR encryption/decryption
+# Uses random IV/Nonce per message and handles padding and authentication errors via ValueError
 
 import os
+import threading
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives import padding
-from cryptography.hazmat.backends import default_backend
 # Note: InvalidPadding import removed for compatibility, using ValueError instead.
-
-# Use a secure backend
-backend = default_backend()
+# The OpenSSL backend is implicit; passing default_backend() per Cipher is a deprecated no-op that only adds call overhead.
 # AES block size is 16 bytes (128 bits)
 AES_BLOCK_SIZE_BYTES = algorithms.AES.block_size // 8
+_VALID_KEY_SIZES = frozenset((16, 24, 32)) # AES-128/192/256; one hash lookup per check
+_PKCS7 = padding.PKCS7(algorithms.AES.block_size) # Stateless configuration; only padder()/unpadder() carry state
+# PKCS7 pad bytes are fixed by len(plaintext) % 16, so all 16 possible pads are built once (index 0 is a full block of 0x10)
+_PKCS7_PADS = tuple(bytes([AES_BLOCK_SIZE_BYTES - i]) * (AES_BLOCK_SIZE_BYTES - i) for i in range(AES_BLOCK_SIZE_BYTES))
+
+# --- IV / Nonce Source ---
+IV_POOL_BYTES = 4096 # One os.urandom() call yields 256 IVs
+_iv_pool = threading.local() # Per-thread, so no lock and no two threads ever share an IV
+
+def _reset_iv_pool():
+    global _iv_pool
+    _iv_pool = threading.local()
+
+if hasattr(os, 'register_at_fork'): # A forked child must not hand out the parent's remaining IVs again
+    os.register_at_fork(after_in_child=_reset_iv_pool)
 
-# --- AES-CBC Functions (Secure: Random IV per encryption) ---
+def _fresh_iv() -> bytes:
+    """ Next 16 random bytes from this thread's pool; each IV is handed out once, refilled by one os.urandom() call when empty. """
+    try: return _iv_pool.ivs.pop()
+    except (AttributeError, IndexError): # First use in this thread, or pool exhausted
+        buf = os.urandom(IV_POOL_BYTES)
+        _iv_pool.ivs = [buf[i:i + AES_BLOCK_SIZE_BYTES] for i in range(0, IV_POOL_BYTES, AES_BLOCK_SIZE_BYTES)]
+        return _iv_pool.ivs.pop()
+
+# --- AES-GCM Functions (Preferred: Random nonce per encryption, authenticated) ---
+
+GCM_NONCE_SIZE_BYTES = 12 # 96-bit nonce, the size GCM is designed for
+GCM_TAG_SIZE_BYTES = 16
+
+def encrypt_gcm(key: bytes, plaintext: bytes, aad: bytes = b'') -> tuple[bytes, bytes, bytes]:
+    """
+    Encrypts and authenticates plaintext (and aad, which stays in the clear) using AES-GCM with a random nonce.
+    One pass: no padding, and the tag replaces a separate integrity check.
+    Args: key (bytes), plaintext (bytes), aad (bytes) Returns: tuple (nonce, ciphertext, tag)
+    """
+    if len(key) not in _VALID_KEY_SIZES:
+         raise ValueError("Invalid AES key size. Must be 16, 24, or 32 bytes.")
+    nonce = _fresh_iv()[:GCM_NONCE_SIZE_BYTES] # Fresh random nonce
+    sealed = AESGCM(key).encrypt(nonce, plaintext, aad or None) # ciphertext || tag
+    return nonce, sealed[:-GCM_TAG_SIZE_BYTES], sealed[-GCM_TAG_SIZE_BYTES:]
+
+def decrypt_gcm(key: bytes, nonce: bytes, ciphertext: bytes, tag: bytes, aad: bytes = b'') -> bytes:
+    """
+    Verifies and decrypts AES-GCM ciphertext. Any tampering with nonce, ciphertext, tag or aad raises ValueError.
+    Args: key (bytes), nonce (bytes), ciphertext (bytes), tag (bytes), aad (bytes) Returns: plaintext (bytes)
+    """
+    if len(key) not in _VALID_KEY_SIZES:
+         raise ValueError("Invalid AES key size. Must be 16, 24, or 32 bytes.")
+    if len(nonce) != GCM_NONCE_SIZE_BYTES:
+         raise ValueError(f"Invalid Nonce size. Must be {GCM_NONCE_SIZE_BYTES} bytes.")
+    if len(tag) != GCM_TAG_SIZE_BYTES:
+         raise ValueError(f"Invalid tag size. Must be {GCM_TAG_SIZE_BYTES} bytes.")
+    try:
+        return AESGCM(key).decrypt(nonce, ciphertext + tag, aad or None)
+    except InvalidTag:
+        raise ValueError("Authentication failed: ciphertext, nonce, tag or AAD was modified.") from None
+
+# --- AES-CBC Functions (Legacy: Random IV per encryption, unauthenticated; prefer GCM) ---
 
 def encrypt_cbc(key: bytes, plaintext: bytes) -> tuple[bytes, bytes]:
     """
     Encrypts plaintext using AES-CBC with a securely generated random IV.
     Args: key (bytes), plaintext (bytes) Returns: tuple (iv, ciphertext)
     """
-    if len(key) not in [16, 24, 32]:
+    if len(key) not in _VALID_KEY_SIZES:
          raise ValueError("Invalid AES key size. Must be 16, 24, or 32 bytes.")
-    iv = os.urandom(AES_BLOCK_SIZE_BYTES) # Fresh random IV
-    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=backend)
+    return _encrypt_cbc_with(algorithms.AES(key), plaintext)
+
+def encrypt_cbc_batch(key: bytes, plaintexts: list[bytes]) -> list[tuple[bytes, bytes]]:
+    """
+    Encrypts many plaintexts under one key, each with its own random IV (e.g. all pending TXs before gossip).
+    The key is checked and wrapped once; CBC chains through every block, so each message still gets its own encryptor.
+    Args: key (bytes), plaintexts (list of bytes) Returns: list of (iv, ciphertext), in input order
+    """
+    if len(key) not in _VALID_KEY_SIZES:
+         raise ValueError("Invalid AES key size. Must be 16, 24, or 32 bytes.")
+    algorithm = algorithms.AES(key)
+    return [_encrypt_cbc_with(algorithm, plaintext) for plaintext in plaintexts]
+
+def _encrypt_cbc_with(algorithm, plaintext: bytes) -> tuple[bytes, bytes]:
+    iv = _fresh_iv() # Fresh random IV
+    cipher = Cipher(algorithm, modes.CBC(iv))
     encryptor = cipher.encryptor()
-    padder = padding.PKCS7(algorithms.AES.block_size).padder()
-    padded_data = padder.update(plaintext) + padder.finalize()
+    padded_data = plaintext + _PKCS7_PADS[len(plaintext) % AES_BLOCK_SIZE_BYTES] # Same bytes as _PKCS7.padder()
     ciphertext = encryptor.update(padded_data) + encryptor.finalize()
     return iv, ciphertext
 
@@ -35,16 +104,16 @@ def decrypt_cbc(key: bytes, iv: bytes, ciphertext: bytes) -> bytes:
     Decrypts AES-CBC ciphertext. Handles padding errors via ValueError.
     Args: key (bytes), iv (bytes), ciphertext (bytes) Returns: plaintext (bytes)
     """
-    if len(key) not in [16, 24, 32]:
+    if len(key) not in _VALID_KEY_SIZES:
          raise ValueError("Invalid AES key size. Must be 16, 24, or 32 bytes.")
     if len(iv) != AES_BLOCK_SIZE_BYTES:
         raise ValueError(f"Invalid IV size. Must be {AES_BLOCK_SIZE_BYTES} bytes.")
 
-    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=backend)
+    cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
     decryptor = cipher.decryptor()
     try:
         decrypted_padded_data = decryptor.update(ciphertext) + decryptor.finalize()
-        unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+        unpadder = _PKCS7.unpadder()
         plaintext = unpadder.update(decrypted_padded_data) + unpadder.finalize()
         return plaintext
     except ValueError as e:
@@ -53,32 +122,67 @@ def decrypt_cbc(key: bytes, iv: bytes, ciphertext: bytes) -> bytes:
         print(f"Decryption or Unpadding error (ValueError): {e}")
         raise # Re-raise the exception
 
-# --- AES-CTR Functions (Secure: Unique Nonce per encryption) ---
+# --- AES-CTR Functions (Legacy: Unique Nonce per encryption, unauthenticated; prefer GCM) ---
 
 def encrypt_ctr(key: bytes, plaintext: bytes) -> tuple[bytes, bytes]:
     """
     Encrypts plaintext using AES-CTR with a securely generated random nonce.
     Args: key (bytes), plaintext (bytes) Returns: tuple (nonce, ciphertext)
     """
-    if len(key) not in [16, 24, 32]:
+    if len(key) not in _VALID_KEY_SIZES:
          raise ValueError("Invalid AES key size. Must be 16, 24, or 32 bytes.")
-    nonce = os.urandom(AES_BLOCK_SIZE_BYTES) # Fresh random nonce
-    cipher = Cipher(algorithms.AES(key), modes.CTR(nonce), backend=backend)
+    nonce = _fresh_iv() # Fresh random nonce
+    cipher = Cipher(algorithms.AES(key), modes.CTR(nonce))
     encryptor = cipher.encryptor()
     ciphertext = encryptor.update(plaintext) + encryptor.finalize() # No padding needed
     return nonce, ciphertext
 
+_COUNTER_MASK = (1 << 128) - 1 # The CTR counter block is a 128-bit big-endian integer that wraps around
+# Longest message whose counter blocks go into the shared ECB keystream. Building counters is Python work per block,
+# so messages longer than 256 bytes are encrypted with one OpenSSL CTR call each instead.
+CTR_SHARED_KEYSTREAM_MAX = 256
+
+def encrypt_ctr_batch(key: bytes, plaintexts: list[bytes]) -> list[tuple[bytes, bytes]]:
+    """
+    Encrypts many plaintexts under one key, each with its own random nonce, producing exactly what encrypt_ctr would.
+    CTR keystream blocks are independent, so the counter blocks of every short message go through a single ECB encryptor
+    (one key schedule, one OpenSSL call); each is then XORed with its slice of the keystream. Messages longer than
+    CTR_SHARED_KEYSTREAM_MAX are encrypted by OpenSSL's CTR mode directly.
+    Args: key (bytes), plaintexts (list of bytes) Returns: list of (nonce, ciphertext), in input order
+    """
+    if len(key) not in _VALID_KEY_SIZES:
+         raise ValueError("Invalid AES key size. Must be 16, 24, or 32 bytes.")
+    algorithm = algorithms.AES(key)
+    nonces = [_fresh_iv() for _ in plaintexts] # Fresh random nonce per message
+    counter_blocks = []
+    for nonce, plaintext in zip(nonces, plaintexts):
+        if len(plaintext) > CTR_SHARED_KEYSTREAM_MAX: continue
+        counter = int.from_bytes(nonce, 'big'); n_blocks = -(-len(plaintext) // AES_BLOCK_SIZE_BYTES)
+        counter_blocks.extend(((counter + i) & _COUNTER_MASK).to_bytes(AES_BLOCK_SIZE_BYTES, 'big') for i in range(n_blocks))
+    encryptor = Cipher(algorithm, modes.ECB()).encryptor()
+    keystream = encryptor.update(b"".join(counter_blocks)) + encryptor.finalize()
+    results = []; offset = 0
+    for nonce, plaintext in zip(nonces, plaintexts):
+        length = len(plaintext)
+        if length > CTR_SHARED_KEYSTREAM_MAX:
+            encryptor = Cipher(algorithm, modes.CTR(nonce)).encryptor()
+            results.append((nonce, encryptor.update(plaintext) + encryptor.finalize())); continue
+        stream = int.from_bytes(keystream[offset:offset + length], 'big')
+        results.append((nonce, (int.from_bytes(plaintext, 'big') ^ stream).to_bytes(length, 'big')))
+        offset += -(-length // AES_BLOCK_SIZE_BYTES) * AES_BLOCK_SIZE_BYTES
+    return results
+
 def decrypt_ctr(key: bytes, nonce: bytes, ciphertext: bytes) -> bytes:
     """
     Decrypts AES-CTR ciphertext.
     Args: key (bytes), nonce (bytes), ciphertext (bytes) Returns: plaintext (bytes)
     """
-    if len(key) not in [16, 24, 32]:
+    if len(key) not in _VALID_KEY_SIZES:
          raise ValueError("Invalid AES key size. Must be 16, 24, or 32 bytes.")
     if len(nonce) != AES_BLOCK_SIZE_BYTES:
          raise ValueError(f"Invalid Nonce size. Must be {AES_BLOCK_SIZE_BYTES} bytes.")
 
-    cipher = Cipher(algorithms.AES(key), modes.CTR(nonce), backend=backend)
+    cipher = Cipher(algorithms.AES(key), modes.CTR(nonce))
     decryptor = cipher.decryptor() # CTR decryption is same operation as encryption
     try:
         plaintext = decryptor.update(ciphertext) + decryptor.finalize()
@@ -151,4 +255,24 @@ if __name__ == "__main__":
     except Exception as e: # Catch broader errors during demo
         print(f"CTR Decryption/Verification Failed: {e}")
 
+    # --- GCM Example ---
+    print("\n" + "="*10 + " Secure GCM Example " + "="*10)
+    tx_data_gcm = b"TX_GCM_1: Sender: Alice, Receiver: Bob, Amount: 3 BTC, Date: 2025-04-03"
+    tx_header_gcm = b"block=42" # Authenticated but not encrypted
+    print(f"Original GCM TX: {tx_data_gcm.decode()}")
+    nonce_gcm, cipher_gcm, tag_gcm = encrypt_gcm(aes_key, tx_data_gcm, tx_header_gcm)
+    print(f"Nonce (hex): {nonce_gcm.hex()}")
+    print(f"Ciphertext GCM (hex): {cipher_gcm.hex()}")
+    print(f"Tag (hex): {tag_gcm.hex()}")
+    try:
+        decrypted_gcm = decrypt_gcm(aes_key, nonce_gcm, cipher_gcm, tag_gcm, tx_header_gcm)
+        print(f"\nDecrypted GCM TX: {decrypted_gcm.decode()}")
+        assert tx_data_gcm == decrypted_gcm
+        print("GCM Message verified.")
+        tampered = bytes([cipher_gcm[0] ^ 1]) + cipher_gcm[1:]
+        try: decrypt_gcm(aes_key, nonce_gcm, tampered, tag_gcm, tx_header_gcm)
+        except ValueError as e: print(f"Tampered GCM TX rejected: {e}")
+    except Exception as e: # Catch broader errors during demo
+        print(f"GCM Decryption/Verification Failed: {e}")
+
     print("\n" + "="*10 + " Python Examples Complete " + "="*10)
\ No newline at end of file